@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark for get_analysis.py and get-qc-stats.py.
+
+For each size, a synthetic SONG payload (generate_song_payload.py) is served
+from a local SONG stand-in and written out as a JSONL dump with its
+qc_metrics tarballs, then each stage of both scripts is timed on it. Results
+can be saved and compared against a previous run; stages slower than the
+baseline by more than --tolerance are reported as regressions and the run
+exits non-zero.
+"""
+
+import os
+import io
+import sys
+import json
+import gzip
+import math
+import time
+import shutil
+import tempfile
+import platform
+import threading
+import contextlib
+import importlib.util
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+
+import get_analysis
+from generate_song_payload import PayloadGenerator, analyses_per_donor, write_qc_tarballs
+
+aggregators = [
+    ('Picard:CollectQualityYieldMetrics', get_analysis.aggregate_gatk_quality_yield_metrics),
+    ('Samtools:stats', get_analysis.aggregate_samtools_stats_metrics),
+    ('Sanger:compareBamGenotypes', get_analysis.aggregate_sanger_compareBamGenotypes_metrics),
+    ('Sanger:verifyBamHomChk', get_analysis.aggregate_sanger_verifyBamHomChk_metrics),
+    ('GATK:CollectOxoGMetrics', get_analysis.aggregate_gatk_oxo_metrics),
+    ('biobambam2:bammarkduplicates2', get_analysis.aggregate_picard_mark_duplicates_metrics),
+    ('Picard:CollectRnaSeqMetrics', get_analysis.aggreate_picard_collect_rnaseq_metrics)
+]
+
+# one representative figure set per experiment: (metrics key, pipelines, metric)
+plot_metrics = {
+    'WGS': [
+        ('biobambam2:bammarkduplicates2', ['BWA-MEM'], 'DUPLICATION_PCT'),
+        ('Samtools:stats', ['BWA-MEM'], 'total_reads'),
+        ('Samtools:stats', ['BWA-MEM'], 'error_rate'),
+        ('GATK:CollectOxoGMetrics', ['BWA-MEM'], 'oxoQ_score')
+    ],
+    'WXS': [
+        ('biobambam2:bammarkduplicates2', ['BWA-MEM'], 'DUPLICATION_PCT'),
+        ('Samtools:stats', ['BWA-MEM'], 'total_reads'),
+        ('Samtools:stats', ['BWA-MEM'], 'error_rate'),
+        ('GATK:CollectOxoGMetrics', ['BWA-MEM'], 'oxoQ_score')
+    ],
+    'RNA-Seq': [
+        ('biobambam2:bammarkduplicates2', ['STAR', 'HISAT2'], 'DUPLICATION_PCT'),
+        ('Picard:CollectRnaSeqMetrics', ['STAR', 'HISAT2'], 'pct_mrna_bases'),
+        ('Picard:CollectRnaSeqMetrics', ['STAR', 'HISAT2'], 'median_cv_coverage')
+    ]
+}
+
+
+def load_qc_stats():
+    spec = importlib.util.spec_from_file_location('get_qc_stats', os.path.join(script_dir, 'get-qc-stats.py'))
+    module = importlib.util.module_from_spec(spec)
+    # registered so worker processes can unpickle its functions
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class SongHandler(BaseHTTPRequestHandler):
+    """
+    Paginated SONG study endpoint over an in-memory list of analyses. Pages
+    are encoded once up front so the server does not compete with the
+    client being timed.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if not url.path.endswith('/analysis/paginated'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        key = (int(query['limit'][0]), int(query['offset'][0]))
+        body = self.server.pages.get(key)
+        if body is None:
+            body = self.server.encode_page(*key)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SongServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, analyses, page_size):
+        ThreadingHTTPServer.__init__(self, ('localhost', 0), SongHandler)
+        self.analyses = analyses
+        self.pages = {}
+        for offset in range(0, len(analyses), page_size):
+            self.pages[(page_size, offset)] = self.encode_page(page_size, offset)
+
+    def encode_page(self, limit, offset):
+        page = self.analyses[offset:offset + limit]
+        return gzip.compress(json.dumps({
+            'analyses': page,
+            'totalAnalyses': len(self.analyses),
+            'currentTotalAnalyses': len(page)
+        }).encode(), compresslevel=1)
+
+    @property
+    def url(self):
+        return 'http://localhost:%s' % self.server_address[1]
+
+
+class StageTimer(object):
+    def __init__(self, quiet=True):
+        self.timings = {}
+        self.quiet = quiet
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        output = io.StringIO() if self.quiet else sys.stdout
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            yield
+        self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - start
+
+
+def benchmark_get_analysis(timer, analyses, study_id, experiments, workspace, args):
+    server = SongServer(analyses, args.page_size)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = get_analysis.SongClient(server.url, page_size=args.page_size)
+        with timer.stage('get_analysis.song_phone_home'):
+            fetched = list(get_analysis.song_phone_home(client, study_id, 'PUBLISHED'))
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with timer.stage('get_analysis.build_analysis_index'):
+        index = get_analysis.build_analysis_index(fetched)
+
+    metrics = {}
+    for key, aggregator in aggregators:
+        with timer.stage('get_analysis.%s' % aggregator.__name__):
+            metrics[key] = aggregator(index, None, False)
+
+    for experiment in experiments:
+        with timer.stage('get_analysis.generate_rdpc_metadata'):
+            metadata = get_analysis.generate_rdpc_metadata(index, experiment)
+
+        specs = {}
+        for plot_level in ['sample', 'donor']:
+            for key, cols, item in plot_metrics[experiment]:
+                if len(metrics[key]) == 0:
+                    continue
+                title = '%s %s %s %s' % (study_id, experiment, plot_level + 'Lvl', item)
+                specs[title.replace(' ', '_')] = get_analysis.plot_spec(key, 1000, 600, cols, [item], title, plot_level, args.max_points)
+        with timer.stage('get_analysis.generate_plot'):
+            plots = get_analysis.render_plots(metadata, metrics, specs)
+        with timer.stage('get_analysis.save_pkl_plots'):
+            get_analysis.save_pkl_plots(
+                os.path.join(workspace, 'plots', experiment), plots, True, args.image_format, 1, None, 'pkl')
+
+
+def benchmark_qc_stats(timer, qc_stats, dump_path, workspace, parse_jobs=1):
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    try:
+        # every tarball is already on disk and matches SONG, so download() only
+        # scans the dump and checks its manifest
+        with timer.stage('get-qc-stats.download'):
+            qc_stats.download(dump_path, 'qc_metrics', None, None, None)
+        with timer.stage('get-qc-stats.process_qc_metrics'):
+            variant_calling_stats = qc_stats.process_qc_metrics(dump_path, {}, None, parse_jobs)
+        with timer.stage('get-qc-stats.report'):
+            rows = [qc_stats.get_dict_value(None, v, qc_stats.variant_calling_stats_fields) for v in variant_calling_stats.values()]
+            qc_stats.report(rows, os.path.join('report', 'benchmark.qc.tsv'))
+    finally:
+        os.chdir(cwd)
+
+
+def run_size(size, args, qc_stats):
+    donors = int(math.ceil(size / float(analyses_per_donor(args.experiment, args.read_groups))))
+    analyses = list(PayloadGenerator(args.study_id, args.seed, args.read_groups).analyses(donors, args.experiment))
+    workspace = tempfile.mkdtemp(prefix='song-benchmark-', dir=args.work_dir)
+    try:
+        if 'get-qc-stats' in args.scripts:
+            write_qc_tarballs(analyses, workspace)
+        dump_path = os.path.join(workspace, 'data', 'rdpc-song.%s.benchmark.jsonl' % args.study_id)
+        if not os.path.exists(os.path.dirname(dump_path)):
+            os.makedirs(os.path.dirname(dump_path))
+        with open(dump_path, 'w') as f:
+            for analysis in analyses:
+                f.write(json.dumps(analysis) + '\n')
+
+        stages = {}
+        for _ in range(args.repeat):
+            timer = StageTimer(quiet=not args.verbose)
+            if 'get_analysis' in args.scripts:
+                benchmark_get_analysis(timer, analyses, args.study_id, args.experiment, workspace, args)
+            if 'get-qc-stats' in args.scripts:
+                benchmark_qc_stats(timer, qc_stats, os.path.abspath(dump_path), workspace, args.parse_jobs)
+            for name, seconds in timer.timings.items():
+                stages[name] = min(stages.get(name, seconds), seconds)
+    finally:
+        if args.keep:
+            print('Kept workspace %s' % workspace)
+        else:
+            shutil.rmtree(workspace)
+    return {'analyses': len(analyses), 'donors': donors, 'stages': stages}
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    regressions = []
+    for size, result in results['sizes'].items():
+        previous = baseline.get('sizes', {}).get(size)
+        if previous is None:
+            continue
+        for name, seconds in result['stages'].items():
+            before = previous['stages'].get(name)
+            if before is None:
+                continue
+            if seconds > before * (1 + tolerance) and seconds - before > min_seconds:
+                regressions.append((size, name, before, seconds))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    for size, result in results['sizes'].items():
+        print('\n%s analyses (%s donors)' % (result['analyses'], result['donors']))
+        previous = (baseline or {}).get('sizes', {}).get(size, {}).get('stages', {})
+        for name, seconds in sorted(result['stages'].items()):
+            if name in previous and previous[name] > 0:
+                print('  %-60s %10.3fs  (baseline %.3fs, x%.2f)' % (name, seconds, previous[name], seconds / previous[name]))
+            else:
+                print('  %-60s %10.3fs' % (name, seconds))
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark get_analysis.py and get-qc-stats.py on synthetic SONG payloads')
+    parser.add_argument("-n", "--sizes", dest="sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="approximate number of analyses per run")
+    parser.add_argument("-e", "--experiment", dest="experiment", nargs="+", default=['WGS', 'RNA-Seq'], choices=['RNA-Seq', 'WGS', 'WXS'])
+    parser.add_argument("--scripts", dest="scripts", nargs="+", default=['get_analysis', 'get-qc-stats'], choices=['get_analysis', 'get-qc-stats'])
+    parser.add_argument("-s", "--study_id", dest="study_id", type=str, default='TEST-CA')
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=1, help="runs per size, the fastest time per stage is kept")
+    parser.add_argument("--read_groups", dest="read_groups", type=int, default=3)
+    parser.add_argument("--page_size", dest="page_size", type=int, default=500)
+    parser.add_argument("--max_points", dest="max_points", type=int, default=0)
+    parser.add_argument("--parse_jobs", dest="parse_jobs", type=int, default=1, help="worker processes parsing tarballs in process_qc_metrics")
+    parser.add_argument("-f", "--image_format", dest="image_format", nargs="+", default=['none'], choices=['svg', 'png', 'pdf', 'none'],
+                        help="image export is slow and needs kaleido, so it is off by default")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="write results as json")
+    parser.add_argument("-b", "--baseline", dest="baseline", type=str, default=None, help="results json from a previous run to compare against")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--min_seconds", dest="min_seconds", type=float, default=0.05, help="ignore slowdowns smaller than this")
+    parser.add_argument("-w", "--work_dir", dest="work_dir", type=str, default=None, help="where generated payloads and tarballs are written")
+    parser.add_argument("-k", "--keep", dest="keep", action="store_true", help="keep the generated workspace")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="show the scripts' own output")
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+
+    qc_stats = load_qc_stats() if 'get-qc-stats' in args.scripts else None
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'experiment': args.experiment,
+        'sizes': {}
+    }
+    for size in args.sizes:
+        print('Benchmarking %s analyses...' % size)
+        results['sizes'][str(size)] = run_size(size, args, qc_stats)
+        print('Benchmarking %s analyses...Complete' % size)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        if regressions:
+            print('\nRegressions (more than %d%% slower than baseline):' % (args.tolerance * 100))
+            for size, name, before, seconds in regressions:
+                print('  %s analyses : %s %.3fs -> %.3fs' % (size, name, before, seconds))
+            sys.exit(1)
+        print('\nNo regressions against %s' % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
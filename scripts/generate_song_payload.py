@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+Generate synthetic SONG analyses for benchmarking get_analysis.py and
+get-qc-stats.py offline.
+
+Every donor gets a normal and a tumour sample per experiment. DNA samples
+(WGS/WXS) carry sequencing_alignment and qc_metrics analyses with the
+file info.metrics blocks read by the aggregate_* functions, and tumours
+additionally get sanger/mutect2 variant_calling and QC analyses. RNA-Seq
+samples get one STAR and one HISAT2 qc_metrics analysis. With --tarballs,
+the matching qc_metrics tarballs are written under
+<tarballs>/data/qc_metrics/<study>/ the way download() lays them out.
+"""
+
+import os
+import io
+import json
+import random
+import hashlib
+import tarfile
+from argparse import ArgumentParser
+
+rna_metrics = [
+    "median_3prime_bias",
+    "median_5prime_bias",
+    "median_5prime_to_3prime_bias",
+    "median_cv_coverage",
+    "pct_coding_bases",
+    "pct_correct_strand_reads",
+    "pct_intergenic_bases",
+    "pct_intronic_bases",
+    "pct_mrna_bases",
+    "pct_r1_transcript_strand_reads",
+    "pct_r2_transcript_strand_reads",
+    "pct_ribosomal_bases",
+    "pct_usable_bases",
+    "pct_utr_bases"
+]
+
+duplicates_metrics = [
+    'READ_PAIRS_EXAMINED',
+    'READ_PAIR_DUPLICATES',
+    'READ_PAIR_OPTICAL_DUPLICATES',
+    'UNMAPPED_READS',
+    'UNPAIRED_READS_EXAMINED',
+    'UNPAIRED_READ_DUPLICATES'
+]
+
+
+class PayloadGenerator(object):
+    def __init__(self, study_id='TEST-CA', seed=0, read_groups=3, state='PUBLISHED'):
+        self.study_id = study_id
+        self.random = random.Random(seed)
+        self.read_groups = read_groups
+        self.state = state
+        self.counter = 0
+
+    def next_id(self, prefix):
+        self.counter += 1
+        return '%s%08d' % (prefix, self.counter)
+
+    def qc_file(self, file_name, data_type, tools, metrics, data_subtypes, tarball=True):
+        return {
+            'objectId': self.next_id('OBJ'),
+            'studyId': self.study_id,
+            'fileName': file_name,
+            'fileSize': self.random.randint(1000, 100000),
+            'fileMd5sum': '%032x' % self.random.getrandbits(128),
+            'fileType': 'TGZ' if tarball else 'JSON',
+            'dataType': data_type,
+            'info': {
+                'data_category': 'Quality Control Metrics',
+                'data_subtypes': data_subtypes,
+                'analysis_tools': tools,
+                'metrics': metrics
+            }
+        }
+
+    def analysis(self, analysis_type, sample, experiment, workflow, files):
+        return {
+            'analysisId': self.next_id('AN'),
+            'studyId': self.study_id,
+            'analysisState': self.state,
+            'updatedAt': '2022-01-01T00:00:00.000Z',
+            'analysisType': {'name': analysis_type, 'version': 1},
+            'samples': [sample],
+            'experiment': dict(experiment),
+            'workflow': {'workflow_short_name': workflow, 'run_id': self.next_id('wes-')},
+            'files': files
+        }
+
+    def sample(self, donor, designation, experiment, matched_normal=None):
+        sample_id = self.next_id('SA')
+        return {
+            'sampleId': sample_id,
+            'submitterSampleId': 'sub-%s' % sample_id,
+            'matchedNormalSubmitterSampleId': matched_normal,
+            'sampleType': 'Total DNA' if experiment != 'RNA-Seq' else 'Total RNA',
+            'specimen': {
+                'specimenId': self.next_id('SP'),
+                'submitterSpecimenId': 'sub-sp-%s' % sample_id,
+                'tumourNormalDesignation': designation
+            },
+            'donor': donor
+        }
+
+    def alignment_metrics(self, experiment):
+        total_reads = self.random.randint(10 ** 8, 10 ** 9)
+        average_length = self.random.choice([100, 125, 150])
+        total_bases = total_reads * average_length
+        paired_reads = total_reads - self.random.randint(0, 1000)
+        return {
+            'average_insert_size': self.random.randint(250, 550),
+            'average_length': average_length,
+            'duplicated_bases': int(total_bases * self.random.uniform(0.02, 0.3)),
+            'error_rate': self.random.uniform(0.001, 0.01),
+            'mapped_bases_cigar': int(total_bases * self.random.uniform(0.9, 0.99)),
+            'mapped_reads': int(total_reads * self.random.uniform(0.95, 0.999)),
+            'mismatch_bases': int(total_bases * self.random.uniform(0.001, 0.01)),
+            'paired_reads': paired_reads,
+            'pairs_on_different_chromosomes': int(paired_reads * self.random.uniform(0.001, 0.02)),
+            'properly_paired_reads': int(paired_reads * self.random.uniform(0.9, 0.99)),
+            'total_bases': total_bases,
+            'total_reads': total_reads
+        }
+
+    def duplicates_file(self, prefix):
+        libraries = []
+        for _ in range(self.random.randint(1, 3)):
+            library = {key: self.random.randint(10 ** 5, 10 ** 7) for key in duplicates_metrics}
+            library['LIBRARY'] = self.next_id('LIB')
+            libraries.append(library)
+        return self.qc_file(
+            '%s.duplicates_metrics.tgz' % prefix, 'Sample QC',
+            ['biobambam2:bammarkduplicates2'], {'libraries': libraries}, ['Duplicates Metrics'])
+
+    def dna_analyses(self, sample, experiment):
+        sample_id = sample['sampleId']
+        prefix = '%s.%s.%s.aln' % (self.study_id, sample['donor']['donorId'], sample_id)
+        read_group_files = []
+        for read_group in range(self.read_groups):
+            read_group_id = '%s-rg%d' % (sample_id, read_group)
+            total_reads = self.random.randint(10 ** 7, 10 ** 8)
+            read_group_files.append(self.qc_file(
+                '%s.%s.lane.cram.ubam_qc_metrics.tgz' % (prefix, read_group_id), 'Sample QC',
+                ['Picard:CollectQualityYieldMetrics'],
+                {'read_group_id': read_group_id, 'total_reads': total_reads, 'read_length': 150,
+                 'pf_reads': total_reads - self.random.randint(0, 1000)},
+                ['Read Group Metrics']))
+
+        alignment = self.analysis('sequencing_alignment', sample, experiment, 'dna-seq-alignment', [{
+            'objectId': self.next_id('OBJ'),
+            'studyId': self.study_id,
+            'fileName': '%s.cram' % prefix,
+            'fileSize': self.random.randint(10 ** 10, 10 ** 11),
+            'fileMd5sum': '%032x' % self.random.getrandbits(128),
+            'fileType': 'CRAM',
+            'dataType': 'Aligned Reads',
+            'info': {'data_category': 'Sequencing Reads', 'analysis_tools': ['BWA-MEM', 'biobambam2:bammarkduplicates2']}
+        }])
+        qc = self.analysis('qc_metrics', sample, experiment, 'dna-seq-alignment', [
+            self.qc_file('%s.cram.qc_metrics.tgz' % prefix, 'Sample QC', ['Samtools:stats'],
+                         self.alignment_metrics(experiment), ['Alignment Metrics']),
+            self.duplicates_file(prefix),
+            self.qc_file('%s.cram.oxog_metrics.tgz' % prefix, 'Sample QC', ['GATK:CollectOxoGMetrics'],
+                         {'oxoQ_score': self.random.uniform(20, 60)}, ['OxoG Metrics'])
+        ] + read_group_files)
+        return [alignment, qc]
+
+    def tumour_calling_analyses(self, tumour, normal, experiment):
+        strategy = experiment['experimental_strategy'].lower()
+        prefix = '%s.%s.%s' % (self.study_id, tumour['donor']['donorId'], tumour['sampleId'])
+        analyses = []
+        for workflow in ['sanger-%s' % strategy, 'gatk-mutect2']:
+            analyses.append(self.analysis('variant_calling', tumour, experiment, workflow, [{
+                'objectId': self.next_id('OBJ'),
+                'studyId': self.study_id,
+                'fileName': '%s.%s.snv.vcf.gz' % (prefix, workflow),
+                'fileSize': self.random.randint(10 ** 6, 10 ** 8),
+                'fileMd5sum': '%032x' % self.random.getrandbits(128),
+                'fileType': 'VCF',
+                'dataType': 'Raw SNV Calls',
+                'info': {'data_category': 'Simple Nucleotide Variation'}
+            }]))
+
+        sanger_files = []
+        for sample in [tumour, normal]:
+            sanger_files.append(self.qc_file(
+                '%s.sanger-%s.%s.verifyBamHomChk.tgz' % (prefix, strategy, sample['sampleId']), 'Analysis QC',
+                ['Sanger:verifyBamHomChk'],
+                {'sample_id': sample['sampleId'], 'avg_depth': self.random.uniform(20, 60),
+                 'contamination': self.random.uniform(0, 0.05), 'reads_used': self.random.randint(10 ** 5, 10 ** 6),
+                 'snps_used': self.random.randint(10 ** 4, 10 ** 5)},
+                ['Cross Sample Contamination']))
+        sanger_files.append(self.qc_file(
+            '%s.sanger-%s.ascat.tgz' % (prefix, strategy), 'Analysis QC', ['Sanger:ascat'],
+            {'NormalContamination': self.random.uniform(0, 0.3), 'Ploidy': self.random.uniform(1.5, 4),
+             'rho': self.random.uniform(0.2, 1)},
+            ['Ploidy', 'Tumour Purity']))
+        sanger_files.append(self.qc_file(
+            '%s.sanger-%s.compareBamGenotypes.tgz' % (prefix, strategy), 'Analysis QC', ['Sanger:compareBamGenotypes'],
+            {'compared_against': normal['sampleId'], 'total_loci_gender': 4,
+             'total_loci_genotype': self.random.randint(1000, 5000),
+             'tumours': [{'sample_id': tumour['sampleId'],
+                          'gender': {'frac_match_gender': self.random.uniform(0.9, 1), 'gender': 'XX'},
+                          'genotype': {'frac_informative_genotype': self.random.uniform(0.5, 1),
+                                       'frac_matched_genotype': self.random.uniform(0.9, 1)}}]},
+            ['Genotyping Stats']))
+        analyses.append(self.analysis('qc_metrics', tumour, experiment, 'sanger-%s' % strategy, sanger_files))
+
+        analyses.append(self.analysis('qc_metrics', tumour, experiment, 'gatk-mutect2', [
+            self.qc_file('%s.gatk-mutect2.%s.contamination_metrics.tgz' % (prefix, sample['sampleId']), 'Analysis QC',
+                         ['GATK:CalculateContamination'],
+                         {'sample_id': sample['sampleId'], 'contamination': self.random.uniform(0, 0.05),
+                          'error': self.random.uniform(0, 0.01)},
+                         ['Cross Sample Contamination'])
+            for sample in [tumour, normal]
+        ] + [
+            self.qc_file('%s.gatk-mutect2.callable_stats.tgz' % prefix, 'Analysis QC', ['GATK:Mutect2'],
+                         {'callable': self.random.randint(10 ** 9, 3 * 10 ** 9)}, ['Variant Callable Stats'])
+        ]))
+        return analyses
+
+    def rna_analyses(self, sample, experiment):
+        analyses = []
+        for aligner in ['star', 'hisat2']:
+            prefix = '%s.%s.%s.%s' % (self.study_id, sample['donor']['donorId'], sample['sampleId'], aligner)
+            analyses.append(self.analysis('qc_metrics', sample, experiment, 'rna-seq-alignment', [
+                self.qc_file('%s.collectrnaseqmetrics.tgz' % prefix, 'Sample QC', ['Picard:CollectRnaSeqMetrics'],
+                             dict({metric: self.random.uniform(0, 1) for metric in rna_metrics}, pf_bases=self.random.randint(10 ** 9, 10 ** 10)),
+                             ['RNA Alignment Metrics']),
+                self.duplicates_file(prefix)
+            ]))
+        return analyses
+
+    def donor_analyses(self, experiments):
+        donor_id = self.next_id('DO')
+        donor = {'donorId': donor_id, 'submitterDonorId': 'sub-%s' % donor_id,
+                 'gender': self.random.choice(['Female', 'Male'])}
+        analyses = []
+        for experimental_strategy in experiments:
+            experiment = {'experimental_strategy': experimental_strategy, 'platform': 'ILLUMINA'}
+            normal = self.sample(donor, 'Normal', experimental_strategy)
+            tumour = self.sample(donor, 'Tumour', experimental_strategy, normal['submitterSampleId'])
+            for sample in [normal, tumour]:
+                if experimental_strategy == 'RNA-Seq':
+                    analyses.extend(self.rna_analyses(sample, experiment))
+                else:
+                    analyses.extend(self.dna_analyses(sample, experiment))
+            if experimental_strategy != 'RNA-Seq':
+                analyses.extend(self.tumour_calling_analyses(tumour, normal, experiment))
+        return analyses
+
+    def analyses(self, donors, experiments):
+        for _ in range(donors):
+            for analysis in self.donor_analyses(experiments):
+                yield analysis
+
+
+def analyses_per_donor(experiments, read_groups=3):
+    return len(PayloadGenerator(read_groups=read_groups).donor_analyses(experiments))
+
+
+def write_qc_tarball(fname, analysis, fl):
+    """
+    A qc_metrics tarball holding what get-qc-stats.py reads back: the
+    file's metrics as <name>.extra_info.json, plus an .aln.cram.bamstat for
+    Alignment Metrics files. The file record's fileSize and fileMd5sum are
+    updated to match it.
+    """
+    name = fl['fileName'].replace('.tgz', '')
+    members = [('%s.extra_info.json' % name, json.dumps({'metrics': fl['info']['metrics']}).encode())]
+    if 'Alignment Metrics' in fl['info']['data_subtypes']:
+        bamstat = 'SN\traw total sequences:\t%d\nSN\taverage length:\t%d\nSN\tinsert size standard deviation:\t%.1f\n' % (
+            fl['info']['metrics']['total_reads'], fl['info']['metrics']['average_length'], fl['info']['metrics']['average_insert_size'] * 0.25)
+        members.append(('%s.aln.cram.bamstat' % analysis['samples'][0]['sampleId'], bamstat.encode()))
+
+    with tarfile.open(fname, 'w:gz') as tar:
+        for member_name, content in members:
+            info = tarfile.TarInfo(member_name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+    # the SONG record describes the tarball actually written
+    with open(fname, 'rb') as f:
+        fl['fileMd5sum'] = hashlib.md5(f.read()).hexdigest()
+    fl['fileSize'] = os.path.getsize(fname)
+    return fl['fileSize']
+
+
+def write_qc_tarballs(analyses, root):
+    count = 0
+    for analysis in analyses:
+        if not analysis['analysisType']['name'] == 'qc_metrics': continue
+        output_dir = os.path.join(root, 'data', 'qc_metrics', analysis['studyId'])
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        for fl in analysis['files']:
+            write_qc_tarball(os.path.join(output_dir, fl['fileName']), analysis, fl)
+            count += 1
+    return count
+
+
+def main():
+    parser = ArgumentParser(description='Generate a synthetic SONG payload')
+    parser.add_argument("-n", "--donors", dest="donors", type=int, default=100, help="number of donors")
+    parser.add_argument("-e", "--experiment", dest="experiment", nargs="+", default=['WGS'], choices=['RNA-Seq', 'WGS', 'WXS'])
+    parser.add_argument("-s", "--study_id", dest="study_id", type=str, default='TEST-CA')
+    parser.add_argument("-r", "--read_groups", dest="read_groups", type=int, default=3, help="read groups per aligned sample")
+    parser.add_argument("-f", "--format", dest="format", type=str, default='jsonl', choices=['json', 'jsonl'],
+                        help="json : one array, as the SONG study endpoint returns; jsonl : one analysis per line, as a SONG dump")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="defaults to rdpc-song.<study_id>.synthetic.<format>")
+    parser.add_argument("-t", "--tarballs", dest="tarballs", type=str, default=None, help="also write qc_metrics tarballs under this directory")
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = PayloadGenerator(args.study_id, args.seed, args.read_groups)
+    analyses = list(generator.analyses(args.donors, args.experiment))
+    if args.tarballs:
+        print('Wrote %s qc_metrics tarballs' % write_qc_tarballs(analyses, args.tarballs))
+
+    output = args.output or 'rdpc-song.%s.synthetic.%s' % (args.study_id, args.format)
+    with open(output, 'w') as f:
+        if args.format == 'json':
+            json.dump(analyses, f)
+        else:
+            for analysis in analyses:
+                f.write(json.dumps(analysis) + '\n')
+    print('Wrote %s analyses for %s donors to %s' % (len(analyses), args.donors, output))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,6 @@
 import json
 import os
 import csv
-import glob
 from argparse import ArgumentParser
 import sys
 import subprocess
@@ -13,6 +12,27 @@ import pandas as pd
 import numpy as np
 from datetime import date
 import tarfile
+import gzip
+import lzma
+import io
+import contextlib
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from profiling import profiler, cprofiled
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
@@ -60,48 +80,116 @@ variant_calling_stats_fields = {
     'mutect2_callable': 'tumour.mutect2.callable'
 }
 
-def get_extra_metrics(fname, extra_metrics, metrics):
+@profiler.profiled('get_extra_metrics')
+def get_extra_metrics(fname, extra_metrics, metrics, cache=None):
     if not os.path.isfile(fname): 
+        profiler.count('get_extra_metrics', missing=1)
         return metrics
+    metrics.update(cached_parse(fname, 'bamstat', cache))
+    return metrics
+
+@profiler.profiled('get_extra_calling_metrics')
+def get_extra_calling_metrics(fname, cache=None):
+    metrics = {}
+    if not os.path.isfile(fname): 
+        profiler.count('get_extra_calling_metrics', missing=1)
+        return metrics
+    return cached_parse(fname, 'extra_info', cache)
+
+def parse_bamstat(fname):
     collected_sum_fields = {
         'insert size standard deviation': 'insert_size_sd'
     }
-    
-    unzip_dir = 'data/qc_metrics/unzip'
-    if os.path.isdir(unzip_dir): 
-        cmd = 'rm -rf %s && mkdir %s && tar -C %s -xzf %s' % (unzip_dir, unzip_dir, unzip_dir, fname)
-    else:
-        cmd = 'mkdir %s && tar -C %s -xzf %s' % (unzip_dir, unzip_dir, fname)
-    run_cmd(cmd)
+    metrics = {}
 
-    for fn in glob.glob(os.path.join(unzip_dir, '*.aln.cram.bamstat')):    
-        with open(fn, 'r') as f:
-            for row in f:
-                if not row.startswith('SN\t'): continue
-                cols = row.replace(':', '').strip().split('\t')
+    # stream the bamstat straight out of the archive, nothing is extracted to disk
+    try:
+        with tarfile.open(fname, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith('.aln.cram.bamstat'): continue
+                if os.path.dirname(os.path.normpath(member.name)): continue
+                for row in tar.extractfile(member):
+                    row = row.decode('utf-8')
+                    if not row.startswith('SN\t'): continue
+                    cols = row.replace(':', '').strip().split('\t')
+
+                    if not cols[1] in collected_sum_fields: continue
+                    metrics.update({
+                        collected_sum_fields[cols[1]]: float(cols[2]) if ('.' in cols[2] or 'e' in cols[2]) else int(cols[2])
+                        })
+    except tarfile.TarError as e:
+        sys.exit('Unable to read %s: %s' % (fname, e))
 
-                if not cols[1] in collected_sum_fields: continue
-                metrics.update({
-                    collected_sum_fields[cols[1]]: float(cols[2]) if ('.' in cols[2] or 'e' in cols[2]) else int(cols[2])
-                    })
-        
     return metrics
 
-def get_extra_calling_metrics(fname):
+def parse_extra_info(fname):
     metrics = {}
-    if not os.path.isfile(fname): 
-        return metrics
+    # members are read lazily, so the archive is only decompressed up to the json
+    with tarfile.open(fname) as tar:
+        for member in tar:
+            if member.name.endswith('.extra_info.json'):
+                f = tar.extractfile(member)
+                extra_info = json.load(f)
+                metrics = extra_info.get('metrics')
+                break
 
-    tar = tarfile.open(fname)
-    for member in tar.getmembers():
-        if member.name.endswith('.extra_info.json'):
-            f = tar.extractfile(member)
-            extra_info = json.load(f)
-            metrics = extra_info.get('metrics')
-            break
-                
     return metrics
 
+tarball_parsers = {
+    'bamstat': parse_bamstat,
+    'extra_info': parse_extra_info
+}
+
+def cached_parse(fname, kind, cache=None):
+    if cache is not None:
+        hit, metrics = cache.get(fname, kind)
+        if hit:
+            profiler.count('metrics_cache', hits=1)
+            return metrics
+        profiler.count('metrics_cache', misses=1)
+    metrics = tarball_parsers[kind](fname)
+    if cache is not None:
+        cache.put(fname, kind, metrics)
+    return metrics
+
+
+class MetricsCache(object):
+    """
+    SQLite cache of the metrics parsed out of qc_metrics tarballs, keyed by
+    path and parser kind. An entry is only used while the file still has
+    the size and mtime it had when it was parsed, so an unchanged tarball
+    is decompressed once.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS metrics ('
+                        'path TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER, metrics TEXT, '
+                        'PRIMARY KEY (path, kind))')
+        self.pending = 0
+
+    def get(self, fname, kind):
+        st = os.stat(fname)
+        row = self.db.execute('SELECT size, mtime_ns, metrics FROM metrics WHERE path = ? AND kind = ?', (fname, kind)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return False, None
+        return True, json.loads(row[2])
+
+    def put(self, fname, kind, metrics):
+        st = os.stat(fname)
+        self.db.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)',
+                        (fname, kind, st.st_size, st.st_mtime_ns, json.dumps(metrics)))
+        self.pending += 1
+        if self.pending >= 1000:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
 def report(donor, report_name):
     report_dir = os.path.dirname(report_name)
     if not os.path.exists(report_dir):
@@ -153,7 +241,292 @@ def get_dict_value(fields, json_obj, field_map):
         tsv_obj[f] = value
     return tsv_obj 
 
-def download(song_dump, file_type, ACCESSTOKEN, METADATA_URL, STORAGE_URL, include=None, subfolder=None):
+def get_decoder(name='auto'):
+    """
+    JSON decoder for the SONG dump lines: orjson or msgspec when installed,
+    else the stdlib. Lines the fast decoders reject (e.g. integers beyond 64
+    bits) are handed to json.loads, so the result never depends on which
+    decoder is installed.
+    """
+    if name in ('auto', 'orjson') and orjson is not None:
+        fast = orjson.loads
+    elif name in ('auto', 'msgspec') and msgspec is not None:
+        fast = msgspec.json.Decoder().decode
+    elif name in ('auto', 'json'):
+        return json.loads
+    else:
+        sys.exit('JSON decoder %s is not installed' % name)
+
+    def loads(line):
+        try:
+            return fast(line)
+        except ValueError:
+            return json.loads(line)
+    return loads
+
+
+json_loads = get_decoder()
+
+
+def interned(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class FileRecord(object):
+    """
+    The fields of a SONG file entry that download() and process_qc_metrics()
+    read; data_subtypes is empty when the file has none.
+    """
+    __slots__ = ('objectId', 'studyId', 'fileName', 'fileSize', 'fileMd5sum', 'dataType', 'data_category', 'data_subtypes', 'metrics')
+
+    def __init__(self, fl):
+        info = fl.get('info') or {}
+        self.objectId = fl.get('objectId')
+        self.studyId = interned(fl.get('studyId'))
+        self.fileName = fl.get('fileName')
+        self.fileSize = fl.get('fileSize')
+        self.fileMd5sum = fl.get('fileMd5sum')
+        self.dataType = interned(fl.get('dataType'))
+        self.data_category = interned(info.get('data_category'))
+        self.data_subtypes = tuple(interned(subtype) for subtype in info.get('data_subtypes') or ())
+        self.metrics = info.get('metrics')
+
+
+class AnalysisRecord(object):
+    """
+    The fields of a SONG analysis that download() and process_qc_metrics()
+    read, flattened out of samples[0], experiment and workflow.
+    """
+    __slots__ = ('analysisId', 'updatedAt', 'studyId', 'analysisState', 'analysisType', 'workflow_short_name', 'experimental_strategy',
+                 'tumourNormalDesignation', 'sampleId', 'submitterSampleId', 'matchedNormalSubmitterSampleId',
+                 'donorId', 'submitterDonorId', 'gender', 'files')
+
+    def __init__(self, analysis):
+        sample = (analysis.get('samples') or [{}])[0]
+        donor = sample.get('donor') or {}
+        experiment = analysis.get('experiment') or {}
+        self.analysisId = analysis.get('analysisId')
+        self.updatedAt = analysis.get('updatedAt')
+        self.studyId = interned(analysis.get('studyId'))
+        self.analysisState = interned(analysis.get('analysisState'))
+        self.analysisType = interned((analysis.get('analysisType') or {}).get('name'))
+        self.workflow_short_name = interned((analysis.get('workflow') or {}).get('workflow_short_name'))
+        self.experimental_strategy = interned(experiment.get('experimental_strategy') or experiment.get('library_strategy'))
+        self.tumourNormalDesignation = interned((sample.get('specimen') or {}).get('tumourNormalDesignation'))
+        self.sampleId = sample.get('sampleId')
+        self.submitterSampleId = sample.get('submitterSampleId')
+        self.matchedNormalSubmitterSampleId = sample.get('matchedNormalSubmitterSampleId')
+        self.donorId = donor.get('donorId')
+        self.submitterDonorId = donor.get('submitterDonorId')
+        self.gender = interned(donor.get('gender'))
+        self.files = [FileRecord(fl) for fl in analysis.get('files') or ()]
+
+
+dump_buffer_size = 1 << 20  # sequential scans
+seek_buffer_size = 1 << 13  # indexed reads, so a seek does not pull in a full scan buffer for one line
+dump_compressions = OrderedDict([  # magic bytes: [compression, file suffix]
+    (b'\x1f\x8b', ['gzip', '.gz']),
+    (b'\x28\xb5\x2f\xfd', ['zstd', '.zst']),
+    (b'\xfd7zXZ\x00', ['xz', '.xz'])
+])
+
+
+def dump_compression(song_dump):
+    with open(song_dump, 'rb') as f:
+        magic = f.read(6)
+    for prefix, (compression, suffix) in dump_compressions.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+@contextlib.contextmanager
+def open_dump(song_dump):
+    """
+    Open a SONG dump for reading in binary mode, decompressing gzip, zstd or
+    xz on the fly (detected from the magic bytes, not the name) behind a
+    large read buffer.
+    """
+    compression = dump_compression(song_dump)
+    if compression is None:
+        with open(song_dump, 'rb', buffering=dump_buffer_size) as fp:
+            yield fp
+        return
+
+    with open(song_dump, 'rb', buffering=dump_buffer_size) as raw:
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw, mode='rb')
+        elif compression == 'xz':
+            stream = lzma.LZMAFile(raw, mode='rb')
+        elif zstandard is None:
+            sys.exit('%s is zstd compressed, install zstandard to read it' % song_dump)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_size=dump_buffer_size, read_across_frames=True)
+        with io.BufferedReader(stream, buffer_size=dump_buffer_size) as fp:
+            yield fp
+
+
+def dump_study_id(song_dump):
+    """
+    Study id from a dump named like rdpc-song.<study>.<date>.jsonl, with or
+    without a compression suffix.
+    """
+    name = os.path.basename(song_dump)
+    for compression, suffix in dump_compressions.values():
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name.split('.')[-3]
+
+
+def read_analyses(fp):
+    """
+    Yield an AnalysisRecord for every PUBLISHED analysis in a SONG dump
+    opened in binary mode; lines without the word are not decoded at all.
+    """
+    for fline in fp:
+        if b'PUBLISHED' not in fline: continue
+        analysis = json_loads(fline)
+        if not analysis.get('analysisState') == 'PUBLISHED': continue
+        yield AnalysisRecord(analysis)
+
+
+def matches(analysis, where, include=None):
+    if include and not analysis.analysisId in include:
+        return False
+    return any(all(getattr(analysis, field) in values for field, values in condition.items()) for condition in where)
+
+
+@contextlib.contextmanager
+def read_dump(song_dump, where, include=None, study_id=None, dump_index=True):
+    """
+    Iterate the PUBLISHED analyses of a SONG dump that match where, a list of
+    {field: allowed values} alternatives, and whose analysisId is in include
+    when given. Uncompressed dumps are read through their DumpIndex, seeking
+    only to the matching lines; compressed dumps cannot be seeked and are
+    scanned. Analyses come in dump order either way.
+    """
+    where = study_where(where, study_id)
+    lines = indexed_lines(song_dump, where, dump_index)
+    if lines is None:
+        with open_dump(song_dump) as fp:
+            yield (analysis for analysis in read_analyses(fp) if matches(analysis, where, include))
+    else:
+        with open(song_dump, 'rb', buffering=seek_buffer_size) as fp:
+            yield seek_analyses(fp, lines, include)
+
+
+def study_where(where, study_id=None):
+    if not study_id:
+        return where
+    return [dict(condition, studyId=[study_id]) for condition in where]
+
+
+def indexed_lines(song_dump, where, dump_index=True):
+    """
+    DumpIndex rows of the PUBLISHED lines matching where, or None when the
+    dump is compressed, indexing is off or the index cannot be opened.
+    """
+    if not dump_index or dump_compression(song_dump) is not None:
+        return None
+    try:
+        index = DumpIndex(song_dump)
+    except sqlite3.Error as e:
+        print('Dump index unavailable (%s), scanning %s' % (e, song_dump))
+        return None
+    try:
+        return index.lines(where)
+    finally:
+        index.close()
+
+
+def seek_analyses(fp, lines, include=None):
+    for offset, length, analysisId, updatedAt in lines:
+        if include and not analysisId in include: continue
+        fp.seek(offset)
+        yield AnalysisRecord(json_loads(fp.read(length)))
+
+
+class DumpIndex(object):
+    """
+    Sidecar SQLite index (<dump>.idx.sqlite) of an uncompressed SONG dump:
+    the byte offset and length of every line with its analysisId, updatedAt,
+    studyId, analysisType, analysisState and tumourNormalDesignation. Built
+    by one scan of the dump and rebuilt whenever the dump's size or mtime
+    changes.
+    """
+    fields = ['analysisId', 'updatedAt', 'studyId', 'analysisType', 'analysisState', 'tumourNormalDesignation']
+    version = 2
+
+    def __init__(self, song_dump):
+        self.song_dump = song_dump
+        self.db = sqlite3.connect(song_dump + '.idx.sqlite')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            self.db.execute('DROP TABLE IF EXISTS dump')
+            self.db.execute('DROP TABLE IF EXISTS analyses')
+            self.db.execute('PRAGMA user_version = %d' % self.version)
+        self.db.execute('CREATE TABLE IF NOT EXISTS dump (size INTEGER, mtime_ns INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS analyses ('
+                        'offset INTEGER PRIMARY KEY, length INTEGER, %s)' % ', '.join(field + ' TEXT' for field in self.fields))
+        self.db.execute('CREATE INDEX IF NOT EXISTS analyses_filter ON analyses (analysisState, studyId, analysisType)')
+        st = os.stat(song_dump)
+        if self.db.execute('SELECT size, mtime_ns FROM dump').fetchall() != [(st.st_size, st.st_mtime_ns)]:
+            self.build(st)
+
+    @profiler.profiled('dump_index')
+    def build(self, st):
+        print('Indexing %s...' % self.song_dump)
+        self.db.execute('DELETE FROM dump')
+        self.db.execute('DELETE FROM analyses')
+        rows = []
+        offset = 0
+        with open_dump(self.song_dump) as fp:
+            for fline in fp:
+                analysis = json_loads(fline)
+                sample = (analysis.get('samples') or [{}])[0]
+                rows.append((offset, len(fline),
+                             analysis.get('analysisId'),
+                             analysis.get('updatedAt'),
+                             analysis.get('studyId'),
+                             (analysis.get('analysisType') or {}).get('name'),
+                             analysis.get('analysisState'),
+                             (sample.get('specimen') or {}).get('tumourNormalDesignation')))
+                offset += len(fline)
+                if len(rows) >= 10000:
+                    self.db.executemany('INSERT INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    profiler.count('dump_index', analyses=len(rows))
+                    rows = []
+        self.db.executemany('INSERT INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        profiler.count('dump_index', analyses=len(rows))
+        self.db.execute('INSERT INTO dump VALUES (?, ?)', (st.st_size, st.st_mtime_ns))
+        self.db.commit()
+        print('Indexing %s...Complete' % self.song_dump)
+
+    def lines(self, where):
+        """
+        (offset, length, analysisId, updatedAt) of the PUBLISHED lines
+        matching any of the where conditions, in dump order.
+        """
+        clauses, params = [], []
+        for condition in where:
+            terms = []
+            for field, values in condition.items():
+                if field not in self.fields:
+                    raise ValueError('%s is not indexed' % field)
+                terms.append('%s IN (%s)' % (field, ', '.join('?' * len(values))))
+                params.extend(values)
+            clauses.append('(%s)' % ' AND '.join(terms or ['1']))
+        rows = self.db.execute('SELECT offset, length, analysisId, updatedAt FROM analyses '
+                               'WHERE analysisState = ? AND (%s) ORDER BY offset' % ' OR '.join(clauses),
+                               ['PUBLISHED'] + params).fetchall()
+        profiler.count('dump_index', selected=len(rows))
+        return rows
+
+    def close(self):
+        self.db.close()
+
+
+@profiler.profiled('download', lambda download_flist: {'files': len(download_flist)})
+def download(song_dump, file_type, ACCESSTOKEN, METADATA_URL, STORAGE_URL, include=None, subfolder=None, jobs=1, study_id=None, dump_index=True):
 
     file_type_map = { # [analysisType, dataType, data_category]
         "qc_metrics": ['qc_metrics', ['Analysis QC', 'Sample QC'], 'Quality Control Metrics'],
@@ -171,68 +544,193 @@ def download(song_dump, file_type, ACCESSTOKEN, METADATA_URL, STORAGE_URL, inclu
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
-    downloaded = []
-    for fn in glob.glob(os.path.join(data_dir, "*-*", "*.*"), recursive=True):
-        downloaded.append(os.path.basename(fn))
+    manifest = DownloadManifest(os.path.join(data_dir, 'manifest.tsv'))
 
     download_flist = set()
-    with open(song_dump, 'r') as fp:
-        for fline in fp:
-            analysis = json.loads(fline)
-            # print(analysis['analysisId'])
-            if include and not analysis['analysisId'] in include: continue
-            if not analysis.get('analysisState') == 'PUBLISHED': continue
-            if not analysis['analysisType']['name'] == file_type_map[file_type][0]: continue
-            output_dir = os.path.join(data_dir, analysis['studyId'])
+    pending = OrderedDict()
+    with read_dump(song_dump, [{'analysisType': [file_type_map[file_type][0]]}], include, study_id, dump_index) as analyses:
+        for analysis in analyses:
+            profiler.count('download', analyses=1)
+            # print(analysis.analysisId)
+            if include and not analysis.analysisId in include: continue
+            if not analysis.analysisType == file_type_map[file_type][0]: continue
+            output_dir = os.path.join(data_dir, analysis.studyId)
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
 
-            for fl in analysis['files']:
-                if not fl['dataType'] in file_type_map[file_type][1]: continue
-                if file_type_map[file_type][2] is None and 'data_category' in fl['info']: continue
-                if file_type_map[file_type][2] and not fl['info']['data_category'] == file_type_map[file_type][2]: continue
-                download_flist.add(fl['fileName'])
-                if fl['fileName'] in downloaded: continue
-
-                cmd = 'export ACCESSTOKEN=%s && export METADATA_URL=%s \
-                    && export STORAGE_URL=%s && export TRANSPORT_PARALLEL=3 \
-                    && export TRANSPORT_MEMORY=8 \
-                    && docker run -it --rm  -u $(id -u):$(id -g) \
-                    -e ACCESSTOKEN -e METADATA_URL -e STORAGE_URL \
-                    -e TRANSPORT_PARALLEL -e TRANSPORT_MEMORY \
-                    -v "$PWD":"$PWD" -w "$PWD" overture/score:latest /score-client/bin/score-client download \
-                    --study-id %s --object-id %s --output-dir %s' \
-                    % (ACCESSTOKEN, METADATA_URL, STORAGE_URL, fl['studyId'], fl['objectId'], output_dir)
-
-                run_cmd(cmd)
+            for fl in analysis.files:
+                if not fl.dataType in file_type_map[file_type][1]: continue
+                if file_type_map[file_type][2] is None and fl.data_category is not None: continue
+                if file_type_map[file_type][2] and not fl.data_category == file_type_map[file_type][2]: continue
+                download_flist.add(fl.fileName)
+                if manifest.downloaded(fl, os.path.join(output_dir, fl.fileName)): continue
+                pending.setdefault(fl.fileName, (fl, output_dir))
+
+    failures = score_download(list(pending.values()), ACCESSTOKEN, METADATA_URL, STORAGE_URL, jobs, manifest.verified)
+    manifest.save()
+    if failures:
+        for fl, error in failures:
+            print('Download failed for %s (object %s): %s' % (fl.fileName, fl.objectId, error), file=sys.stderr)
+        sys.exit('%s of %s downloads failed, rerun to fetch the missing files' % (len(failures), len(pending)))
     return download_flist
 
 
-def process_qc_metrics(song_dump, variant_calling_stats):
+class DownloadManifest(object):
+    """
+    Persistent record of verified downloads, one row per objectId with the
+    SONG fileName, fileSize and fileMd5sum it was checked against. A file
+    counts as downloaded when its row still matches SONG and the file has
+    the expected size; files found on disk without a row are checked
+    against SONG (size and md5) once and recorded.
+    """
+    fields = ['objectId', 'studyId', 'fileName', 'fileSize', 'fileMd5sum', 'path']
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for record in csv.DictReader(f, delimiter='\t'):
+                    record['fileSize'] = int(record['fileSize']) if record['fileSize'] else None
+                    self.records[record['objectId']] = record
+
+    def downloaded(self, fl, fname):
+        record = self.records.get(fl.objectId)
+        if record and record['path'] == fname and record['fileName'] == fl.fileName \
+                and record['fileSize'] == fl.fileSize and record['fileMd5sum'] == (fl.fileMd5sum or '') \
+                and os.path.isfile(fname) and os.path.getsize(fname) == record['fileSize']:
+            return True
+        self.records.pop(fl.objectId, None)
+        if not os.path.isfile(fname):
+            return False
+        error = self.verified(fl, fname)
+        if error:
+            print('Refetching %s : %s' % (fname, error))
+            os.remove(fname)
+            return False
+        return True
+
+    def verified(self, fl, fname):
+        """
+        Check fname against the SONG file record and add it to the manifest;
+        returns why it does not match, or None.
+        """
+        if not os.path.isfile(fname):
+            return 'missing after download'
+        size = os.path.getsize(fname)
+        if fl.fileSize is not None and size != fl.fileSize:
+            return 'size %s, expected %s' % (size, fl.fileSize)
+        if fl.fileMd5sum:
+            md5 = hashlib.md5()
+            with open(fname, 'rb') as f:
+                for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+                    md5.update(chunk)
+            if md5.hexdigest() != fl.fileMd5sum:
+                return 'md5 %s, expected %s' % (md5.hexdigest(), fl.fileMd5sum)
+        self.records[fl.objectId] = {
+            'objectId': fl.objectId,
+            'studyId': fl.studyId,
+            'fileName': fl.fileName,
+            'fileSize': size,
+            'fileMd5sum': fl.fileMd5sum or '',
+            'path': fname
+        }
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            writer = csv.DictWriter(f, self.fields, delimiter='\t')
+            writer.writeheader()
+            for objectId in sorted(self.records):
+                writer.writerow(self.records[objectId])
+        os.replace(self.path + '.tmp', self.path)
+
+
+def score_download(files, ACCESSTOKEN, METADATA_URL, STORAGE_URL, jobs=1, verify=None):
+    """
+    Fetch (file, output_dir) pairs with score-client, up to jobs containers
+    at a time. Every file is attempted; the ones that failed, or that verify
+    rejects, are returned with their error instead of stopping the run.
+    """
+    def fetch(fl, output_dir):
+        cmd = 'export ACCESSTOKEN=%s && export METADATA_URL=%s \
+            && export STORAGE_URL=%s && export TRANSPORT_PARALLEL=3 \
+            && export TRANSPORT_MEMORY=8 \
+            && docker run --rm  -u $(id -u):$(id -g) \
+            -e ACCESSTOKEN -e METADATA_URL -e STORAGE_URL \
+            -e TRANSPORT_PARALLEL -e TRANSPORT_MEMORY \
+            -v "$PWD":"$PWD" -w "$PWD" overture/score:latest /score-client/bin/score-client download \
+            --study-id %s --object-id %s --output-dir %s' \
+            % (ACCESSTOKEN, METADATA_URL, STORAGE_URL, fl.studyId, fl.objectId, output_dir)
+        p = subprocess.run([cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        if p.returncode != 0:
+            return 'exit code %s: %s' % (p.returncode, p.stderr.decode('utf-8').strip())
+        if verify is not None:
+            return verify(fl, os.path.join(output_dir, fl.fileName))
+
+    failures = []
+    if len(files) == 0:
+        return failures
+    print('Downloading %s files with %s parallel score-client containers...' % (len(files), max(jobs, 1)))
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {pool.submit(fetch, fl, output_dir): fl for fl, output_dir in files}
+        for future in as_completed(futures):
+            try:
+                error = future.result()
+            except Exception as e:
+                error = str(e)
+            if error:
+                failures.append((futures[future], error))
+                profiler.count('download', failed=1)
+            else:
+                profiler.count('download', fetched=1)
+    print('Downloading %s files...Complete, %s failed' % (len(files), len(failures)))
+    return failures
+
+
+qc_metrics_where = [ # the analyses process_qc_metrics reads
+    {'tumourNormalDesignation': ['Tumour']},
+    {'tumourNormalDesignation': ['Normal'], 'analysisType': ['qc_metrics', 'sequencing_alignment']}
+]
+
+
+@profiler.profiled('process_qc_metrics', lambda variant_calling_stats: {'tumour_samples': len(variant_calling_stats)})
+def process_qc_metrics(song_dump, variant_calling_stats, cache=None, jobs=1, study_id=None, dump_index=True, include=None):
     sample_map = {}
-    with open(song_dump, 'r') as fp:
-        for fline in fp:
-            analysis = json.loads(fline)
-            if not analysis.get('analysisState') == 'PUBLISHED': continue
-            if not analysis['samples'][0]['specimen']['tumourNormalDesignation'] == 'Tumour': continue
-            studyId = analysis['studyId']
-            sampleId = analysis['samples'][0]['sampleId']
-            submitterSampleId = analysis['samples'][0]['submitterSampleId']
-            matchedNormal = analysis['samples'][0]['matchedNormalSubmitterSampleId']
-            experimental_strategy = analysis['experiment']['experimental_strategy'] if analysis['experiment'].get('experimental_strategy') else analysis['experiment']['library_strategy']
+    normals = []
+    updates = DeferredUpdates()
+    with read_dump(song_dump, qc_metrics_where, include, study_id, dump_index) as analyses:
+        for analysis in analyses:
+            if analysis.tumourNormalDesignation == 'Normal':
+                if analysis.analysisType in ['qc_metrics', 'sequencing_alignment']:
+                    experimental_strategy = analysis.experimental_strategy
+                    normals.append((
+                        '_'.join([analysis.studyId, experimental_strategy, analysis.submitterSampleId]),
+                        experimental_strategy,
+                        analysis.studyId,
+                        analysis.sampleId,
+                        analysis.submitterSampleId,
+                        analysis.files
+                    ))
+                continue
+            if not analysis.tumourNormalDesignation == 'Tumour': continue
+            studyId = analysis.studyId
+            sampleId = analysis.sampleId
+            submitterSampleId = analysis.submitterSampleId
+            matchedNormal = analysis.matchedNormalSubmitterSampleId
+            experimental_strategy = analysis.experimental_strategy
             normal_sample_id = '_'.join([studyId, experimental_strategy, matchedNormal])
             if not sample_map.get(normal_sample_id): 
                 sample_map[normal_sample_id] = []
             sample_map[normal_sample_id].append(experimental_strategy+"_"+sampleId)
 
-            donorId = analysis['samples'][0]['donor']['donorId']
-            gender = analysis['samples'][0]['donor']['gender']
+            donorId = analysis.donorId
+            gender = analysis.gender
             
             unique_sampleId = experimental_strategy+"_"+sampleId
             if not variant_calling_stats.get(unique_sampleId): variant_calling_stats[unique_sampleId] = {
                 'study_id': studyId,
                 'donor_id': donorId,
-                'submitter_donor_id': analysis['samples'][0]['donor']['submitterDonorId'],
+                'submitter_donor_id': analysis.submitterDonorId,
                 'gender': gender,
                 'experimental_strategy': experimental_strategy,
                 'flags': {
@@ -267,152 +765,378 @@ def process_qc_metrics(song_dump, variant_calling_stats):
                 }
             }
 
-            if analysis['analysisType']['name'] == 'variant_calling': 
-                if analysis['workflow']['workflow_short_name'] in ['sanger-wgs', 'sanger-wxs']:
+            if analysis.analysisType == 'variant_calling': 
+                if analysis.workflow_short_name in ['sanger-wgs', 'sanger-wxs']:
                     variant_calling_stats[unique_sampleId]['flags']['sanger_called'] = True
-                if analysis['workflow']['workflow_short_name'] == 'gatk-mutect2':
+                if analysis.workflow_short_name == 'gatk-mutect2':
                     variant_calling_stats[unique_sampleId]['flags']['mutect2_called'] = True
-            elif analysis['analysisType']['name'] == 'sequencing_alignment':
+            elif analysis.analysisType == 'sequencing_alignment':
                 variant_calling_stats[unique_sampleId]['flags']['tumour_aligned'] = True
-            elif analysis['analysisType']['name'] == 'variant_processing':
+            elif analysis.analysisType == 'variant_processing':
                 open_filter_count = variant_calling_stats[unique_sampleId]['tumour']['open_filter_count'] + 1
                 if open_filter_count == 4: 
                   variant_calling_stats[unique_sampleId]['flags']['open_filter'] = True
                 variant_calling_stats[unique_sampleId]['tumour']['open_filter_count'] = open_filter_count
-            elif not analysis['analysisType']['name'] == 'qc_metrics': 
+            elif not analysis.analysisType == 'qc_metrics': 
                 continue
             
-            for fl in analysis['files']:
-                if fl.get('info') and fl['info'].get('data_subtypes') and 'Cross Sample Contamination' in fl['info']['data_subtypes']:
-                    fname = os.path.join("data", 'qc_metrics', analysis['studyId'], fl['fileName'])
-                    metrics = get_extra_calling_metrics(fname)
-                    if metrics['sample_id'] == sampleId:
-                        if 'sanger' in fl['fileName']:
-                            variant_calling_stats[unique_sampleId]['tumour']['sanger']['contamination'].update(metrics)
-                        elif 'gatk-mutect2' in fl['fileName']:
-                            variant_calling_stats[unique_sampleId]['tumour']['mutect2']['contamination'].update(metrics)
-                        else:
-                            pass
-                    else:
-                        if 'sanger' in fl['fileName']:
-                            variant_calling_stats[unique_sampleId]['normal']['sanger']['contamination'].update(metrics)
-                        elif 'gatk-mutect2' in fl['fileName']:
-                            variant_calling_stats[unique_sampleId]['normal']['mutect2']['contamination'].update(metrics)
-                        else:
-                            pass
-                elif fl.get('info') and fl['info'].get('data_subtypes') and 'Ploidy' in fl['info']['data_subtypes'] and 'Tumour Purity' in fl['info']['data_subtypes']:
-                    fname = os.path.join("data", 'qc_metrics', analysis['studyId'], fl['fileName'])
-                    metrics = get_extra_calling_metrics(fname)
-                    variant_calling_stats[unique_sampleId]['tumour']['sanger']['ascat_metrics'].update(metrics)
-                elif fl.get('info') and fl['info'].get('data_subtypes') and 'Genotyping Stats' in fl['info']['data_subtypes']:
-                    fname = os.path.join("data", 'qc_metrics', analysis['studyId'], fl['fileName'])
-                    metrics = get_extra_calling_metrics(fname)
-                    variant_calling_stats[unique_sampleId]['tumour']['sanger']['genotype_inference'].update(metrics['tumours'][0]['gender'])
-                elif fl.get('info') and fl['info'].get('data_subtypes') and 'Alignment Metrics' in fl['info']['data_subtypes'] and 'qc_metrics' in fl['fileName']:
+            for fl in analysis.files:
+                if 'Cross Sample Contamination' in fl.data_subtypes:
+                    fname = os.path.join("data", 'qc_metrics', analysis.studyId, fl.fileName)
+                    updates.add(merge_contamination, variant_calling_stats[unique_sampleId], sampleId, fl.fileName, tarball=(fname, 'extra_info'))
+                elif 'Ploidy' in fl.data_subtypes and 'Tumour Purity' in fl.data_subtypes:
+                    fname = os.path.join("data", 'qc_metrics', analysis.studyId, fl.fileName)
+                    updates.add(dict.update, variant_calling_stats[unique_sampleId]['tumour']['sanger']['ascat_metrics'], tarball=(fname, 'extra_info'))
+                elif 'Genotyping Stats' in fl.data_subtypes:
+                    fname = os.path.join("data", 'qc_metrics', analysis.studyId, fl.fileName)
+                    updates.add(merge_genotype_inference, variant_calling_stats[unique_sampleId]['tumour']['sanger']['genotype_inference'], tarball=(fname, 'extra_info'))
+                elif 'Alignment Metrics' in fl.data_subtypes and 'qc_metrics' in fl.fileName:
                     metrics = {}
                     for fn in ['error_rate', 'properly_paired_reads', 'total_reads', 'average_insert_size', 'average_length', 'pairs_on_different_chromosomes']:
-                        metrics.update({fn: fl['info']['metrics'][fn]})
-                    if fl['info']['metrics']['total_reads']==0: continue
+                        metrics.update({fn: fl.metrics[fn]})
+                    if fl.metrics['total_reads']==0: continue
                     metrics.update({
-                        'duplicate_rate': round(fl['info']['metrics']['duplicated_bases']/(fl['info']['metrics']['total_reads']*fl['info']['metrics']['average_length']), 3)
+                        'duplicate_rate': round(fl.metrics['duplicated_bases']/(fl.metrics['total_reads']*fl.metrics['average_length']), 3)
                         })
                     metrics.update({
-                        'pairs_on_different_chromosomes_rate': round(fl['info']['metrics']['pairs_on_different_chromosomes']*2/(fl['info']['metrics']['paired_reads']), 3)
+                        'pairs_on_different_chromosomes_rate': round(fl.metrics['pairs_on_different_chromosomes']*2/(fl.metrics['paired_reads']), 3)
                     })
                     metrics.update({
-                        'estimated_coverage': round(fl['info']['metrics']['total_bases']/total_size.get(experimental_strategy.lower()), 3)
+                        'estimated_coverage': round(fl.metrics['total_bases']/total_size.get(experimental_strategy.lower()), 3)
                     })
-                    fname = os.path.join("data", 'qc_metrics', analysis['studyId'], fl['fileName'])
-                    extra_metrics = ['insert_size_sd']
-                    metrics = get_extra_metrics(fname, extra_metrics, metrics)
-                    variant_calling_stats[unique_sampleId]['tumour']['alignment'].update(metrics)
-                elif fl.get('info') and fl['info'].get('data_subtypes') and 'OxoG Metrics' in fl['info']['data_subtypes']:
-                    variant_calling_stats[unique_sampleId]['tumour']['alignment'].update({'oxoQ_score': fl['info']['metrics']['oxoQ_score'] if fl['info']['metrics'].get('oxoQ_score') else None})
+                    fname = os.path.join("data", 'qc_metrics', analysis.studyId, fl.fileName)
+                    updates.add(merge_alignment, variant_calling_stats[unique_sampleId]['tumour']['alignment'], metrics, tarball=(fname, 'bamstat'))
+                elif 'OxoG Metrics' in fl.data_subtypes:
+                    updates.add(dict.update, variant_calling_stats[unique_sampleId]['tumour']['alignment'], {'oxoQ_score': fl.metrics['oxoQ_score'] if fl.metrics.get('oxoQ_score') else None})
                     
-                elif fl.get('info') and fl['info'].get('data_subtypes') and 'Variant Callable Stats' in fl['info']['data_subtypes']:
-                    fname = os.path.join("data", 'qc_metrics', analysis['studyId'], fl['fileName'])
-                    metrics = get_extra_calling_metrics(fname)
-                    variant_calling_stats[unique_sampleId]['tumour']['mutect2'].update(metrics)
+                elif 'Variant Callable Stats' in fl.data_subtypes:
+                    fname = os.path.join("data", 'qc_metrics', analysis.studyId, fl.fileName)
+                    updates.add(dict.update, variant_calling_stats[unique_sampleId]['tumour']['mutect2'], tarball=(fname, 'extra_info'))
 
-                elif fl['dataType'] == 'Aligned Reads':
-                    variant_calling_stats[unique_sampleId]['tumour']['alignment'].update({"file_size": round(fl['fileSize']/(1024*1024*1024), 3)})
+                elif fl.dataType == 'Aligned Reads':
+                    updates.add(dict.update, variant_calling_stats[unique_sampleId]['tumour']['alignment'], {"file_size": round(fl.fileSize/(1024*1024*1024), 3)})
 
                 else:
                     continue
                 
 
 
-    with open(song_dump, 'r') as fp:
-        for fline in fp:
-            analysis = json.loads(fline)
-            if not analysis.get('analysisState') == 'PUBLISHED': continue
-            if not analysis['analysisType']['name'] in ['qc_metrics', 'sequencing_alignment']: continue
-            if not analysis['samples'][0]['specimen']['tumourNormalDesignation'] == 'Normal': continue
-
-            experimental_strategy = analysis['experiment']['experimental_strategy'] if analysis['experiment'].get('experimental_strategy') else analysis['experiment']['library_strategy']           
-            studyId = analysis['studyId']
-            submitSampleId = analysis['samples'][0]['submitterSampleId']
-            normal_sample_id = '_'.join([studyId, experimental_strategy, submitSampleId])
-            
-            if not normal_sample_id in sample_map: continue
-            
-            for fl in analysis['files']:
-                if fl.get('info') and fl['info'].get('data_subtypes') and 'Alignment Metrics' in fl['info']['data_subtypes'] and 'qc_metrics' in fl['fileName']:
-                    metrics = {}
-                    for fn in ['error_rate', 'properly_paired_reads', 'total_reads', 'average_insert_size', 'average_length', 'pairs_on_different_chromosomes']:
-                        metrics.update({fn: fl['info']['metrics'][fn]})
-                    if fl['info']['metrics']['total_reads'] == 0: continue    
-                    metrics.update({
-                        'duplicate_rate': round(fl['info']['metrics']['duplicated_bases']/(fl['info']['metrics']['total_reads']*fl['info']['metrics']['average_length']), 3)
-                        })
-                    if fl['info']['metrics']['paired_reads']>0:
-                        metrics.update({
-                            'pairs_on_different_chromosomes_rate': round(fl['info']['metrics']['pairs_on_different_chromosomes']*2/(fl['info']['metrics']['paired_reads']), 3)
-                        })
+    # normals recorded during the scan, resolved once every tumour has registered its matched normal
+    for normal_sample_id, experimental_strategy, studyId, sampleId, submitterSampleId, files in normals:
+        if not normal_sample_id in sample_map: continue
+        
+        for fl in files:
+            if 'Alignment Metrics' in fl.data_subtypes and 'qc_metrics' in fl.fileName:
+                metrics = {}
+                for fn in ['error_rate', 'properly_paired_reads', 'total_reads', 'average_insert_size', 'average_length', 'pairs_on_different_chromosomes']:
+                    metrics.update({fn: fl.metrics[fn]})
+                if fl.metrics['total_reads'] == 0: continue    
+                metrics.update({
+                    'duplicate_rate': round(fl.metrics['duplicated_bases']/(fl.metrics['total_reads']*fl.metrics['average_length']), 3)
+                    })
+                if fl.metrics['paired_reads']>0:
                     metrics.update({
-                        'estimated_coverage': round(fl['info']['metrics']['mapped_bases_cigar']/total_size.get(experimental_strategy.lower()), 3)
+                        'pairs_on_different_chromosomes_rate': round(fl.metrics['pairs_on_different_chromosomes']*2/(fl.metrics['paired_reads']), 3)
                     })
-                    fname = os.path.join("data", 'qc_metrics', analysis['studyId'], fl['fileName'])
-                    extra_metrics = ['insert_size_sd']
-                    metrics = get_extra_metrics(fname, extra_metrics, metrics)
-
-                    for sa in sample_map[normal_sample_id]:
-                        variant_calling_stats[sa]['normal']['sample_id'] = analysis['samples'][0]['sampleId']
-                        variant_calling_stats[sa]['normal']['submitterSampleId'] = analysis['samples'][0]['submitterSampleId']  
-                        variant_calling_stats[sa]['normal']['alignment'].update(metrics)
-                        variant_calling_stats[sa]['flags']['normal_aligned'] = True 
-                elif fl.get('info') and fl['info'].get('data_subtypes') and 'OxoG Metrics' in fl['info']['data_subtypes']:
-                    for sa in sample_map[normal_sample_id]:  
-                        variant_calling_stats[sa]['normal']['alignment'].update({'oxoQ_score': fl['info']['metrics'].get('oxoQ_score', None)})                 
-                elif fl['dataType'] == 'Aligned Reads':
-                    for sa in sample_map[normal_sample_id]:  
-                        variant_calling_stats[sa]['normal']['alignment'].update({"file_size": round(fl['fileSize']/(1024*1024*1024), 3)})                    
-                else:
-                    continue                   
+                metrics.update({
+                    'estimated_coverage': round(fl.metrics['mapped_bases_cigar']/total_size.get(experimental_strategy.lower()), 3)
+                })
+                fname = os.path.join("data", 'qc_metrics', studyId, fl.fileName)
+                updates.add(merge_normal_alignment, [variant_calling_stats[sa] for sa in sample_map[normal_sample_id]], sampleId, submitterSampleId, metrics, tarball=(fname, 'bamstat'))
+            elif 'OxoG Metrics' in fl.data_subtypes:
+                for sa in sample_map[normal_sample_id]:  
+                    updates.add(dict.update, variant_calling_stats[sa]['normal']['alignment'], {'oxoQ_score': fl.metrics.get('oxoQ_score', None)})                 
+            elif fl.dataType == 'Aligned Reads':
+                for sa in sample_map[normal_sample_id]:  
+                    updates.add(dict.update, variant_calling_stats[sa]['normal']['alignment'], {"file_size": round(fl.fileSize/(1024*1024*1024), 3)})                    
+            else:
+                continue                   
 
+    updates.parse(cache, jobs)
+    updates.apply()
     return variant_calling_stats
 
 
+class DeferredUpdates(object):
+    """
+    Updates to variant_calling_stats recorded during the dump scan. Each
+    names the tarball (path, parser kind) it needs, if any; once every
+    tarball has been parsed, serially or in a process pool, the updates are
+    applied in the order they were recorded, so the result does not depend
+    on which archive finished first.
+    """
+    def __init__(self):
+        self.updates = []
+        self.parsed = OrderedDict()
+
+    def add(self, merge, *args, tarball=None):
+        if tarball is not None:
+            self.parsed[tarball] = None
+        self.updates.append((merge, args, tarball))
+
+    def parse(self, cache=None, jobs=1):
+        if jobs <= 1:
+            for tarball in self.parsed:
+                self.parsed[tarball] = parse_tarball(tarball, cache)
+            return
+
+        with profiler.stage('parse_tarballs') as stage:
+            pending = []
+            for tarball in self.parsed:
+                fname, kind = tarball
+                if os.path.isfile(fname) and (cache is None or not cache.get(fname, kind)[0]):
+                    pending.append(tarball)
+                    continue
+                # missing or already cached, resolved here through the same profiled stages
+                self.parsed[tarball] = parse_tarball(tarball, cache)
+                stage['resolved'] = stage.get('resolved', 0) + 1
+
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                for tarball, (metrics, stages) in zip(pending, pool.map(profiled_parse_tarball, pending, chunksize=max(1, len(pending) // (jobs * 8)))):
+                    profiler.merge(stages)
+                    self.parsed[tarball] = metrics
+                    if cache is not None:
+                        profiler.count('metrics_cache', misses=1)
+                        cache.put(tarball[0], tarball[1], metrics)
+            stage['parsed'] = stage.get('parsed', 0) + len(pending)
+
+    def apply(self):
+        for merge, args, tarball in self.updates:
+            if tarball is None:
+                merge(*args)
+            else:
+                merge(*(args + (self.parsed[tarball],)))
+
+
+def parse_tarball(tarball, cache=None):
+    fname, kind = tarball
+    if kind == 'bamstat':
+        return get_extra_metrics(fname, None, {}, cache)
+    return get_extra_calling_metrics(fname, cache)
+
+
+def profiled_parse_tarball(tarball):
+    # worker processes hand their stages back to be merged into the run's profile
+    profiler.reset()
+    return parse_tarball(tarball), profiler.stages
+
+
+def merge_contamination(stats, sampleId, fileName, metrics):
+    if metrics['sample_id'] == sampleId:
+        if 'sanger' in fileName:
+            stats['tumour']['sanger']['contamination'].update(metrics)
+        elif 'gatk-mutect2' in fileName:
+            stats['tumour']['mutect2']['contamination'].update(metrics)
+    else:
+        if 'sanger' in fileName:
+            stats['normal']['sanger']['contamination'].update(metrics)
+        elif 'gatk-mutect2' in fileName:
+            stats['normal']['mutect2']['contamination'].update(metrics)
+
+
+def merge_genotype_inference(genotype_inference, metrics):
+    genotype_inference.update(metrics['tumours'][0]['gender'])
+
+
+def merge_alignment(alignment, metrics, extra_metrics):
+    metrics.update(extra_metrics)
+    alignment.update(metrics)
+
+
+def merge_normal_alignment(tumour_stats, sampleId, submitterSampleId, metrics, extra_metrics):
+    metrics.update(extra_metrics)
+    for stats in tumour_stats:
+        stats['normal']['sample_id'] = sampleId
+        stats['normal']['submitterSampleId'] = submitterSampleId
+        stats['normal']['alignment'].update(metrics)
+        stats['flags']['normal_aligned'] = True
+
+
+def analysis_keys(analysis):
+    """
+    [tumour sample, normal sample] process_qc_metrics files an analysis
+    under; the tumour sample is None for normals.
+    """
+    if analysis.tumourNormalDesignation == 'Normal':
+        return [None, '_'.join([analysis.studyId, analysis.experimental_strategy, analysis.submitterSampleId])]
+    return [analysis.experimental_strategy+"_"+analysis.sampleId,
+            '_'.join([analysis.studyId, analysis.experimental_strategy, analysis.matchedNormalSubmitterSampleId])]
+
+
+def list_qc_analyses(song_dump, state, study_id=None, dump_index=True):
+    """
+    analysisId -> [updatedAt, tumour sample, normal sample] of every analysis
+    process_qc_metrics reads, in dump order. Through the dump index only the
+    analyses that are new or updated since the state was saved are decoded.
+    """
+    where = study_where(qc_metrics_where, study_id)
+    lines = indexed_lines(song_dump, where, dump_index)
+    if lines is None:
+        with read_dump(song_dump, where, dump_index=False) as analyses:
+            return OrderedDict((analysis.analysisId, [analysis.updatedAt] + analysis_keys(analysis)) for analysis in analyses)
+
+    decoded = {}
+    with open(song_dump, 'rb', buffering=seek_buffer_size) as fp:
+        for analysis in seek_analyses(fp, [line for line in lines if not state.unchanged(line[2], line[3])]):
+            decoded[analysis.analysisId] = [analysis.updatedAt] + analysis_keys(analysis)
+    return OrderedDict((line[2], decoded.get(line[2]) or state.analyses[line[2]]) for line in lines)
+
+
+class QCState(object):
+    """
+    Snapshot of the last run: the [updatedAt, tumour sample, normal sample]
+    of every analysis that fed the report and the stats of every tumour
+    sample. A tumour sample is recomputed when one of its analyses, or of
+    its matched normal's, was added, updated or removed since; the others
+    are reused as they are, so the report equals a full run. Tarballs are
+    verified against the SONG md5 on download, so they only change along
+    with their analysis.
+    """
+    version = 1
+
+    def __init__(self, path, study_id=None):
+        self.path = path
+        self.study_id = study_id
+        self.analyses = {}
+        self.samples = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            if state.get('version') == self.version and state.get('study_id') == study_id:
+                self.analyses = state['analyses']
+                self.samples = state['samples']
+
+    def unchanged(self, analysisId, updatedAt):
+        previous = self.analyses.get(analysisId)
+        return previous is not None and updatedAt is not None and previous[0] == updatedAt
+
+    def plan(self, current):
+        """
+        Tumour samples to recompute, and the analysisIds process_qc_metrics
+        needs for them: all of their own analyses and their matched normals'.
+        """
+        affected = set()
+        changed_normals = set()
+        for analysisId in set(current) | set(self.analyses):
+            entry, previous = current.get(analysisId), self.analyses.get(analysisId)
+            if entry is not None and entry == previous and entry[0] is not None: continue
+            for updatedAt, tumour, normal in [e for e in (entry, previous) if e is not None]:
+                if tumour is None:
+                    changed_normals.add(normal)
+                else:
+                    affected.add(tumour)
+
+        matched_normals = OrderedDict()
+        for updatedAt, tumour, normal in current.values():
+            if tumour is not None:
+                matched_normals.setdefault(tumour, set()).add(normal)
+        for tumour, normals in matched_normals.items():
+            if tumour not in self.samples or normals & changed_normals:
+                affected.add(tumour)
+
+        needed_normals = set()
+        for tumour in affected:
+            needed_normals |= matched_normals.get(tumour, set())
+        analysisIds = set(analysisId for analysisId, (updatedAt, tumour, normal) in current.items()
+                          if tumour in affected or (tumour is None and normal in needed_normals))
+        profiler.count('qc_state', analyses=len(current), recomputed_samples=len(affected & set(matched_normals)),
+                       reused_samples=len(set(matched_normals) - affected))
+        return affected, analysisIds
+
+    def update(self, current, affected, recomputed):
+        """
+        variant_calling_stats in dump order, recomputed samples taken from
+        recomputed and the rest from the snapshot, which is then replaced.
+        """
+        variant_calling_stats = {}
+        for updatedAt, tumour, normal in current.values():
+            if tumour is None or tumour in variant_calling_stats: continue
+            variant_calling_stats[tumour] = recomputed[tumour] if tumour in affected else self.samples[tumour]
+        self.analyses = current
+        self.samples = variant_calling_stats
+        return variant_calling_stats
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(OrderedDict([
+                ('version', self.version),
+                ('study_id', self.study_id),
+                ('analyses', self.analyses),
+                ('samples', self.samples)
+            ]), f)
+        os.replace(self.path + '.tmp', self.path)
+
+
 def main():
     parser = ArgumentParser()
-    parser.add_argument("-d", "--dump_path", dest="dump_path", type=str, default="data/rdpc-song.jsonl", help="path to song dump jsonl file")
+    parser.add_argument("-d", "--dump_path", dest="dump_path", type=str, default="data/rdpc-song.jsonl", help="path to song dump jsonl file, optionally gzip, zstd or xz compressed")
     parser.add_argument("-m", "--metadata_url", dest="metadata_url", type=str, default="https://song.rdpc-prod.cumulus.genomeinformatics.org")
     parser.add_argument("-s", "--storage_url", dest="storage_url", type=str, default="https://score.rdpc-prod.cumulus.genomeinformatics.org")
     parser.add_argument("-t", "--token", dest="token", type=str, required=True)
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1, help="score-client downloads run in parallel")
+    parser.add_argument("-c", "--metrics_cache", dest="metrics_cache", type=str, default="data/qc_metrics/parsed_metrics.sqlite",
+                        help="sqlite cache of metrics already parsed out of unchanged tarballs")
+    parser.add_argument("--no_metrics_cache", dest="no_metrics_cache", action="store_true", help="parse every tarball again")
+    parser.add_argument("-p", "--parse_jobs", dest="parse_jobs", type=int, default=1, help="worker processes parsing qc_metrics tarballs")
+    parser.add_argument("--state", dest="state", type=str, default=None,
+                        help="snapshot of the last run's per-sample stats, only samples with new or updated analyses are recomputed (default data/qc_metrics/<study>.qc_state.json)")
+    parser.add_argument("--no_state", dest="no_state", action="store_true", help="recompute every sample and do not keep a snapshot")
+    parser.add_argument("--study_id", dest="study_id", type=str, default=None,
+                        help="only process this study of a multi-study dump (default: every study, reports named after the dump)")
+    parser.add_argument("--no_dump_index", dest="no_dump_index", action="store_true",
+                        help="scan the whole dump instead of seeking through its <dump>.idx.sqlite index")
+    parser.add_argument("--json_decoder", dest="json_decoder", type=str, default="auto", choices=["auto", "orjson", "msgspec", "json"],
+                        help="decoder for the song dump lines, auto picks orjson or msgspec when installed")
+    parser.add_argument("--profile", dest="profile", type=str, nargs="?", const="", default=None,
+                        help="write per-stage time, peak RSS and counts as JSON (default report/<study>.profile.json)")
+    parser.add_argument("--cprofile", dest="cprofile", type=str, default=None, help="also dump cProfile stats of the whole run to this path")
     args = parser.parse_args()
 
+    with cprofiled(args.cprofile):
+        run(args)
+    if args.profile is not None:
+        profiler.write(args.profile or os.path.join('report', (args.study_id or dump_study_id(args.dump_path))+'.profile.json'), 'get-qc-stats.py')
+
+
+def run(args):
+    global json_loads
+    json_loads = get_decoder(args.json_decoder)
     song_dump = args.dump_path
     variant_calling_stats = {}
+    study_id = args.study_id or dump_study_id(args.dump_path)
+
+    include = None
+    if not args.no_state:
+        state = QCState(args.state or os.path.join('data', 'qc_metrics', study_id+'.qc_state.json'), args.study_id)
+        with profiler.stage('qc_state'):
+            current = list_qc_analyses(song_dump, state, args.study_id, not args.no_dump_index)
+            affected, include = state.plan(current)
+        print('QC state : %s tumour samples to recompute from %s analyses' % (len(affected), len(include)))
 
     #download qc_metrics
-    download(song_dump, 'qc_metrics', args.token, args.metadata_url, args.storage_url)
+    if include is None or include:
+        download(song_dump, 'qc_metrics', args.token, args.metadata_url, args.storage_url, include=include, jobs=args.jobs,
+                 study_id=args.study_id, dump_index=not args.no_dump_index)
+
+    cache = None if args.no_metrics_cache else MetricsCache(args.metrics_cache)
+    try:
+        if include is None or include:
+            variant_calling_stats = process_qc_metrics(song_dump, variant_calling_stats, cache, args.parse_jobs,
+                                                       args.study_id, not args.no_dump_index, include)
+    finally:
+        if cache is not None:
+            cache.close()
 
-    variant_calling_stats = process_qc_metrics(song_dump, variant_calling_stats)
+    if not args.no_state:
+        variant_calling_stats = state.update(current, affected, variant_calling_stats)
+        state.save()
 
     report_dir = 'report'
     if not os.path.exists(report_dir):
         os.makedirs(report_dir)
-    study_id = args.dump_path.split('.')[-3]
     with open(os.path.join(report_dir, study_id+'.variant_calling_stats.json'), 'w') as f:
         f.write(json.dumps(variant_calling_stats, indent=2))
 
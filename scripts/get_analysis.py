@@ -23,6 +23,8 @@
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import os
 import argparse
@@ -30,8 +32,15 @@ import plotly
 from plotly.subplots import make_subplots
 import plotly.graph_objs as go
 import pickle
+import hashlib
+import json
+import html
 import sys
+import time
 import warnings
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor,as_completed
+from profiling import profiler,cprofiled
 warnings.filterwarnings('ignore')
 
 def main():
@@ -52,265 +61,596 @@ def main():
                         default=['PUBLISHED'],
                         choices=["PUBLISHED","SUPPRESSED","UNPUBLISHED"],
                         type=str)
+    parser.add_argument('-n', '--page_size', dest="page_size", help="analyses requested per SONG page", default=500,type=int)
+    parser.add_argument('-j', '--jobs', dest="jobs", help="concurrent SONG fetches and worker processes for aggregation and plotting", default=1,type=int)
+    parser.add_argument('-f', '--image_format', dest="image_format", help="image formats exported per figure", default=['svg'],nargs="+",type=str,choices=['svg','png','pdf','none'])
+    parser.add_argument('-w', '--export_jobs', dest="export_jobs", help="worker processes exporting figures, each with its own renderer", default=1,type=int)
+    parser.add_argument('-r', '--reuse_plots', dest="reuse_plots", help="skip figures whose data and parameters are unchanged since the last run", action="store_true")
+    parser.add_argument('-k', '--plot_store', dest="plot_store", help="store figures as small specs over parquet metrics (spec) or as pickled figures (pkl)", default='spec',type=str,choices=['spec','pkl'])
+    parser.add_argument('-t', '--html', dest="html", help="also write one self-contained HTML report with every figure", action="store_true")
+    parser.add_argument('-g', '--webgl_threshold', dest="webgl_threshold", help="traces with more points than this use Scattergl in the HTML report", default=1000,type=int)
+    parser.add_argument('-m', '--max_points', dest="max_points", help="thin sample-level curves to at most this many points per trace (0 keeps all)", default=0,type=int)
+    parser.add_argument('-c', '--cache_dir', dest="cache_dir", help="directory for cached SONG responses, revalidated on each run", default=None,type=str)
+    parser.add_argument('--profile', dest="profile", help="write per-stage time, peak RSS and counts as JSON (default <output_directory>/profile.json)", default=None,nargs="?",const="",type=str)
+    parser.add_argument('--cprofile', dest="cprofile", help="also dump cProfile stats of the whole run to this path", default=None,type=str)
 
     cli_input= parser.parse_args()
 
-    metadata={}
-    for project in cli_input.project:
-        metadata[project]={}
-        for state in cli_input.state:
-            response=song_phone_home(project,cli_input.rdpc_url,state)
+    if cli_input.plot_store=='spec':
+        try:
+            import pyarrow
+        except ImportError:
+            sys.exit("--plot_store spec needs pyarrow for parquet output; install it or use --plot_store pkl")
+
+    with cprofiled(cli_input.cprofile):
+        run(cli_input)
+    if cli_input.profile is not None:
+        profiler.write(cli_input.profile or "%s/profile.json" % cli_input.out_dir,"get_analysis.py")
+
+def run(cli_input):
+    client=SongClient(cli_input.rdpc_url,page_size=cli_input.page_size)
+    cache=SongCache(cli_input.cache_dir) if cli_input.cache_dir else None
+    queries=[(project,state) for project in cli_input.project for state in cli_input.state]
+
+    if cli_input.jobs<=1:
+        for project,state in queries:
+            index=fetch_analysis_index(client,project,state,cache)
             for experiment in cli_input.experiment:
-                write_dir="%s/%s_%s_%s" % (cli_input.out_dir,state,project,experiment)
-                if not os.path.exists(write_dir):
-                    os.makedirs(write_dir)
-
-                tsv_dir="%s/%s" % (write_dir,"tsv")
-                if not os.path.exists(tsv_dir):
-                    os.makedirs(tsv_dir)
-
-                metadata[project][experiment]={}
-                
-                metadata[project][experiment][state]=\
-                generate_rdpc_metadata(response,experiment)
-                
-                metadata[project][experiment][state].iloc[:,:-1].to_csv(
-                    "%s/%s_%s_%s_fileIDs.tsv" % (tsv_dir,state,project,experiment),
-                    sep="\t"
-                )
-                plots={}
-                metrics={}
-                ###RNA-Seq
-                if experiment=='RNA-Seq':
-                    metrics['Picard:CollectRnaSeqMetrics']=aggreate_picard_collect_rnaseq_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
+                process_experiment(index,project,state,experiment,cli_input)
+        return
+
+    ###SONG fetches run in threads, aggregation and plotting in worker processes
+    ###Workers come from a forkserver, forking this process while fetch threads hold locks can deadlock them
+    with ThreadPoolExecutor(max_workers=cli_input.jobs) as fetchers,\
+        ProcessPoolExecutor(max_workers=cli_input.jobs,mp_context=multiprocessing.get_context("forkserver")) as workers:
+        fetches={
+            fetchers.submit(fetch_analysis_index,client,project,state,cache):(project,state)
+            for project,state in queries
+        }
+        jobs=[]
+        for fetch in as_completed(fetches):
+            project,state=fetches[fetch]
+            index=fetch.result()
+            for experiment in cli_input.experiment:
+                jobs.append(workers.submit(profiled_experiment,index,project,state,experiment,cli_input))
+        for job in jobs:
+            profiler.merge(job.result())
+
+def fetch_analysis_index(client,project,state,cache):
+    return(build_analysis_index(song_phone_home(client,project,state,cache)))
+
+def profiled_experiment(index,project,state,experiment,cli_input):
+    ###Worker processes hand their stages back to be merged into the run's profile
+    profiler.reset()
+    process_experiment(index,project,state,experiment,cli_input)
+    return(profiler.stages)
+
+def process_experiment(index,project,state,experiment,cli_input):
+    """
+    Aggregate, tabulate and plot one project x state x experiment.
+    """
+    write_dir="%s/%s_%s_%s" % (cli_input.out_dir,state,project,experiment)
+    if not os.path.exists(write_dir):
+        os.makedirs(write_dir)
+
+    tsv_dir="%s/%s" % (write_dir,"tsv")
+    if not os.path.exists(tsv_dir):
+        os.makedirs(tsv_dir)
+
+    metadata=generate_rdpc_metadata(index,experiment)
+
+    metadata.iloc[:,:-1].to_csv(
+        "%s/%s_%s_%s_fileIDs.tsv" % (tsv_dir,state,project,experiment),
+        sep="\t"
+    )
+    specs={}
+    metrics={}
+    ###Spec-only runs without image export never need the figures themselves
+    render=cli_input.plot_store=='pkl' or cli_input.html or (cli_input.plot and len([image_format for image_format in cli_input.image_format if image_format!='none'])>0)
+    figure_cache=FigureCache(write_dir,cli_input.image_format if cli_input.plot else [],cli_input.plot_store) if cli_input.reuse_plots else None
+    ###RNA-Seq
+    if experiment=='RNA-Seq':
+        metrics['Picard:CollectRnaSeqMetrics']=aggreate_picard_collect_rnaseq_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )
+        metrics['biobambam2:bammarkduplicates2']=aggregate_picard_mark_duplicates_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )                    
+        for plot_level in cli_input.plot_level:
+            if len(metrics['biobambam2:bammarkduplicates2'])>0:
+                for ind,item in enumerate(['TOTAL_READS','DUPLICATION_PCT','MAPPING_PCT']):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'biobambam2:bammarkduplicates2',
+                        1000,
+                        600,
+                        ["STAR","HISAT2"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
                     )
-                    metrics['biobambam2:bammarkduplicates2']=aggregate_picard_mark_duplicates_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
-                    )                    
-                    for plot_level in cli_input.plot_level:
-                        if len(metrics['biobambam2:bammarkduplicates2'])>0:
-                            for ind,item in enumerate(['TOTAL_READS','DUPLICATION_PCT','MAPPING_PCT']):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['biobambam2:bammarkduplicates2'],
-                                    1000,
-                                    600,
-                                    ["STAR","HISAT2"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-                        if len(metrics['Picard:CollectRnaSeqMetrics'])>0:
-                            for ind,item in enumerate([
-                                "median_3prime_bias",
-                                "median_5prime_bias",
-                                "median_5prime_to_3prime_bias",
-                                "median_cv_coverage",
-                                "pct_coding_bases",
-                                "pct_correct_strand_reads",
-                                "pct_intergenic_bases",
-                                "pct_intronic_bases",
-                                "pct_mrna_bases",
-                                "pct_r1_transcript_strand_reads",
-                                "pct_r2_transcript_strand_reads",
-                                "pct_ribosomal_bases",
-                                "pct_usable_bases",
-                                "pct_utr_bases"]):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (2,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['Picard:CollectRnaSeqMetrics'],
-                                    1000,
-                                    600,
-                                    ["STAR","HISAT2"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-                    for key,name in zip(
-                        ['Picard:CollectRnaSeqMetrics','biobambam2:bammarkduplicates2'],
-                        ["rnaMetrics","libraryMetrics"]
-                    ):
-                        if len(metrics[key])>0:
-                            metrics[key].to_csv("%s/%s_%s_%s_%s.tsv" % (tsv_dir,state,project,experiment,name),sep="\t",index=True)
-
-                    save_pkl_plots(write_dir,plots,cli_input.plot)
-                if experiment=='WGS' or experiment=='WXS':
-                    metrics['biobambam2:bammarkduplicates2']=aggregate_picard_mark_duplicates_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
+            if len(metrics['Picard:CollectRnaSeqMetrics'])>0:
+                for ind,item in enumerate([
+                    "median_3prime_bias",
+                    "median_5prime_bias",
+                    "median_5prime_to_3prime_bias",
+                    "median_cv_coverage",
+                    "pct_coding_bases",
+                    "pct_correct_strand_reads",
+                    "pct_intergenic_bases",
+                    "pct_intronic_bases",
+                    "pct_mrna_bases",
+                    "pct_r1_transcript_strand_reads",
+                    "pct_r2_transcript_strand_reads",
+                    "pct_ribosomal_bases",
+                    "pct_usable_bases",
+                    "pct_utr_bases"]):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (2,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'Picard:CollectRnaSeqMetrics',
+                        1000,
+                        600,
+                        ["STAR","HISAT2"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
                     )
-                    metrics['GATK:CollectOxoGMetrics']=aggregate_gatk_oxo_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
+        for key,name in zip(
+            ['Picard:CollectRnaSeqMetrics','biobambam2:bammarkduplicates2'],
+            ["rnaMetrics","libraryMetrics"]
+        ):
+            if len(metrics[key])>0:
+                metrics[key].to_csv("%s/%s_%s_%s_%s.tsv" % (tsv_dir,state,project,experiment,name),sep="\t",index=True)
+
+        plots=render_plots(metadata,metrics,specs,figure_cache) if render else {}
+        if cli_input.plot_store=='spec':
+            save_plot_specs(write_dir,metadata,metrics,specs)
+        save_pkl_plots(write_dir,plots,cli_input.plot,cli_input.image_format,cli_input.export_jobs,figure_cache,cli_input.plot_store)
+        if cli_input.html:
+            save_html_report(
+                "%s/%s_%s_%s_report.html" % (write_dir,state,project,experiment),
+                "%s %s %s" % (state,project,experiment),
+                plots,metadata,metrics,specs,cli_input.webgl_threshold
+            )
+    if experiment=='WGS' or experiment=='WXS':
+        metrics['biobambam2:bammarkduplicates2']=aggregate_picard_mark_duplicates_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )
+        metrics['GATK:CollectOxoGMetrics']=aggregate_gatk_oxo_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )
+        metrics['Samtools:stats']=aggregate_samtools_stats_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )
+        metrics['Picard:CollectQualityYieldMetrics']=aggregate_gatk_quality_yield_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )
+        metrics['Sanger:verifyBamHomChk']=aggregate_sanger_verifyBamHomChk_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )
+        metrics['Sanger:compareBamGenotypes']=aggregate_sanger_compareBamGenotypes_metrics(
+            index,
+            cli_input.excluded_analyses,
+            cli_input.debug
+        )
+
+        for plot_level in cli_input.plot_level:
+            if len(metrics['biobambam2:bammarkduplicates2'])>0:
+                for ind,item in enumerate(['TOTAL_READS','DUPLICATION_PCT','MAPPING_PCT']):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'biobambam2:bammarkduplicates2',
+                        1000,
+                        600,
+                        ["BWA-MEM"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
                     )
-                    metrics['Samtools:stats']=aggregate_samtools_stats_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
+            if len(metrics['GATK:CollectOxoGMetrics'])>0:
+                for ind,item in enumerate(['oxoQ_score']):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'GATK:CollectOxoGMetrics',
+                        1000,
+                        600,
+                        ["BWA-MEM"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
                     )
-                    metrics['Picard:CollectQualityYieldMetrics']=aggregate_gatk_quality_yield_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
+
+            if len(metrics['Samtools:stats'])>0:
+                for ind,item in enumerate(["average_insert_size",
+                    "average_length",
+                    "duplicated_bases",
+                    "error_rate",
+                    "mapped_bases_cigar",
+                    "mapped_reads",
+                    "mismatch_bases",
+                    "paired_reads",
+                    "pairs_on_different_chromosomes",
+                    "properly_paired_reads",
+                    "total_bases",
+                    "total_reads"]):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'Samtools:stats',
+                        1000,
+                        600,
+                        ["BWA-MEM"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
                     )
-                    metrics['Sanger:verifyBamHomChk']=aggregate_sanger_verifyBamHomChk_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
+
+            if len(metrics['Picard:CollectQualityYieldMetrics'])>0 and plot_level=='sample':
+                for ind,item in enumerate(['total_reads','read_length','pf_reads']):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'Picard:CollectQualityYieldMetrics',
+                        1000,
+                        600,
+                        ["BWA-MEM"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
                     )
-                    metrics['Sanger:compareBamGenotypes']=aggregate_sanger_compareBamGenotypes_metrics(
-                        response,
-                        cli_input.excluded_analyses,
-                        cli_input.debug
+
+            if len(metrics['Sanger:verifyBamHomChk'])>0 and plot_level=='sample':
+                for ind,item in enumerate(['avg_depth','contamination','reads_used','snps_used']):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'Sanger:verifyBamHomChk',
+                        1000,
+                        600,
+                        ["BWA-MEM"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
                     )
 
-                    for plot_level in cli_input.plot_level:
-                        if len(metrics['biobambam2:bammarkduplicates2'])>0:
-                            for ind,item in enumerate(['TOTAL_READS','DUPLICATION_PCT','MAPPING_PCT']):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['biobambam2:bammarkduplicates2'],
-                                    1000,
-                                    600,
-                                    ["BWA-MEM"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-                        if len(metrics['GATK:CollectOxoGMetrics'])>0:
-                            for ind,item in enumerate(['oxoQ_score']):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['GATK:CollectOxoGMetrics'],
-                                    1000,
-                                    600,
-                                    ["BWA-MEM"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-
-                        if len(metrics['Samtools:stats'])>0:
-                            for ind,item in enumerate(["average_insert_size",
-                                "average_length",
-                                "duplicated_bases",
-                                "error_rate",
-                                "mapped_bases_cigar",
-                                "mapped_reads",
-                                "mismatch_bases",
-                                "paired_reads",
-                                "pairs_on_different_chromosomes",
-                                "properly_paired_reads",
-                                "total_bases",
-                                "total_reads"]):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['Samtools:stats'],
-                                    1000,
-                                    600,
-                                    ["BWA-MEM"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-
-                        if len(metrics['Picard:CollectQualityYieldMetrics'])>0 and plot_level=='sample':
-                            for ind,item in enumerate(['total_reads','read_length','pf_reads']):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['Picard:CollectQualityYieldMetrics'],
-                                    1000,
-                                    600,
-                                    ["BWA-MEM"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-
-                        if len(metrics['Sanger:verifyBamHomChk'])>0 and plot_level=='sample':
-                            for ind,item in enumerate(['avg_depth','contamination','reads_used','snps_used']):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['Sanger:verifyBamHomChk'],
-                                    1000,
-                                    600,
-                                    ["BWA-MEM"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-
-                        if len(metrics['Sanger:compareBamGenotypes'])>0 and plot_level=='sample':
-                            for ind,item in enumerate(['total_loci_genotype','frac_match_gender','frac_informative_genotype','frac_matched_genotype']):
-                                title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
-                                plots["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=generate_plot(
-                                    metadata[project][experiment][state],
-                                    metrics['Sanger:compareBamGenotypes'],
-                                    1000,
-                                    600,
-                                    ["BWA-MEM"],
-                                    [item],
-                                    title,
-                                    plot_level
-                                )
-                    for key,name in zip(
-                        [
-                            'biobambam2:bammarkduplicates2',
-                            'GATK:CollectOxoGMetrics',
-                            'Samtools:stats',
-                            'Picard:CollectQualityYieldMetrics',
-                            'Sanger:verifyBamHomChk',
-                            'Sanger:compareBamGenotypes'
-                        ],
-                        ["markDupMetrics","oxoMetrics","samtoolsMetrics","readGroupMetrics","verifyBamMetrics","bamGenotypesMetrics"]
-                    ):
-                        if len(metrics[key])>0:
-                            metrics[key].to_csv("%s/%s_%s_%s_%s.tsv" % (tsv_dir,state,project,experiment,name),sep="\t",index=True)
-
-                    save_pkl_plots(write_dir,plots,cli_input.plot)   
-
-def save_pkl_plots(out_dir,gen_plots,plot):
+            if len(metrics['Sanger:compareBamGenotypes'])>0 and plot_level=='sample':
+                for ind,item in enumerate(['total_loci_genotype','frac_match_gender','frac_informative_genotype','frac_matched_genotype']):
+                    title="%s %s %s %s" % (project,experiment,plot_level+"Lvl",item)
+                    specs["fig.%s.%s.%s" % (1,ind+1,title.replace(" ","_"))]=plot_spec(
+                        'Sanger:compareBamGenotypes',
+                        1000,
+                        600,
+                        ["BWA-MEM"],
+                        [item],
+                        title,
+                        plot_level,
+                        cli_input.max_points
+                    )
+        for key,name in zip(
+            [
+                'biobambam2:bammarkduplicates2',
+                'GATK:CollectOxoGMetrics',
+                'Samtools:stats',
+                'Picard:CollectQualityYieldMetrics',
+                'Sanger:verifyBamHomChk',
+                'Sanger:compareBamGenotypes'
+            ],
+            ["markDupMetrics","oxoMetrics","samtoolsMetrics","readGroupMetrics","verifyBamMetrics","bamGenotypesMetrics"]
+        ):
+            if len(metrics[key])>0:
+                metrics[key].to_csv("%s/%s_%s_%s_%s.tsv" % (tsv_dir,state,project,experiment,name),sep="\t",index=True)
+
+        plots=render_plots(metadata,metrics,specs,figure_cache) if render else {}
+        if cli_input.plot_store=='spec':
+            save_plot_specs(write_dir,metadata,metrics,specs)
+        save_pkl_plots(write_dir,plots,cli_input.plot,cli_input.image_format,cli_input.export_jobs,figure_cache,cli_input.plot_store)
+        if cli_input.html:
+            save_html_report(
+                "%s/%s_%s_%s_report.html" % (write_dir,state,project,experiment),
+                "%s %s %s" % (state,project,experiment),
+                plots,metadata,metrics,specs,cli_input.webgl_threshold
+            )
+
+@profiler.profiled("save_pkl_plots")
+def save_pkl_plots(out_dir,gen_plots,plot,image_formats=['svg'],export_jobs=1,figure_cache=None,plot_store='pkl'):
     print("Saving plots...")
-    svg_dir="%s/%s" % (out_dir,"svg")
     pkl_dir="%s/%s" % (out_dir,"pkl")
+    spec_dir="%s/%s" % (out_dir,"spec")
+    ###Figures left as None were found unchanged by the figure cache
+    gen_plots={gen_plot:fig for gen_plot,fig in gen_plots.items() if fig is not None}
+    image_formats=[image_format for image_format in image_formats if image_format!='none'] if plot else []
+    profiler.count("save_pkl_plots",figures=len(gen_plots),pkl=len(gen_plots) if plot_store=='pkl' else 0,images=len(gen_plots)*len(image_formats))
 
-    if not os.path.exists(svg_dir):
-        os.makedirs(svg_dir)
-    if not os.path.exists(pkl_dir):
+    if plot_store=='pkl' and not os.path.exists(pkl_dir):
         os.makedirs(pkl_dir)
-    for gen_plot in gen_plots.keys():
-        file = open("%s/%s.pkl" % (pkl_dir,gen_plot),"wb")
-        pickle.dump(gen_plots[gen_plot],file)
-        file.close()
+    for image_format in image_formats:
+        if not os.path.exists("%s/%s" % (out_dir,image_format)):
+            os.makedirs("%s/%s" % (out_dir,image_format))
+    if plot_store=='pkl':
+        for gen_plot in gen_plots.keys():
+            file = open("%s/%s.pkl" % (pkl_dir,gen_plot),"wb")
+            pickle.dump(gen_plots[gen_plot],file)
+            file.close()
     print("Saving plots...Complete")
 
-    if plot:
-        print("Saving plots SVGs...")
-        for gen_plot in gen_plots.keys():
-            gen_plots[gen_plot].write_image("%s/%s.svg" % (svg_dir,gen_plot))
-        print("Saving plots SVGs...Complete")
+    if len(image_formats)>0 and len(gen_plots)>0:
+        print("Saving plots %s..." % "/".join([image_format.upper() for image_format in image_formats]))
+        exports=[
+            (gen_plots[gen_plot],"%s/%s/%s.%s" % (out_dir,image_format,gen_plot,image_format),image_format)
+            for image_format in image_formats
+            for gen_plot in gen_plots.keys()
+        ]
+        start=time.time()
+        if export_jobs>1:
+            ###Each worker keeps its own renderer alive for all of its figures
+            with ProcessPoolExecutor(max_workers=export_jobs,initializer=start_image_renderer) as exporters:
+                timings=list(exporters.map(export_image,exports))
+        else:
+            start_image_renderer()
+            timings=[export_image(export) for export in exports]
+        print_export_summary(timings,time.time()-start)
+        print("Saving plots %s...Complete" % "/".join([image_format.upper() for image_format in image_formats]))
+
+    if figure_cache is not None:
+        for gen_plot,fig in gen_plots.items():
+            figure_cache.commit(
+                fig,
+                ["%s/%s.pkl" % (pkl_dir,gen_plot) if plot_store=='pkl' else "%s/%s.json" % (spec_dir,gen_plot)]+\
+                ["%s/%s/%s.%s" % (out_dir,image_format,gen_plot,image_format) for image_format in image_formats]
+            )
+        figure_cache.save()
+
+def plot_spec(metrics_key,x_dim,y_dim,cols,rows,title,plot_level,max_points=0):
+    return({
+        "metrics":metrics_key,
+        "x_dim":x_dim,
+        "y_dim":y_dim,
+        "cols":cols,
+        "rows":rows,
+        "title":title,
+        "plot_level":plot_level,
+        "max_points":max_points
+    })
+
+def render_plots(metadata,metrics,specs,figure_cache=None):
+    plots={}
+    ###Donor figures of one metrics table share its prepared tumour/normal frames for this call only
+    donor_frames={}
+    for name,spec in specs.items():
+        plots[name]=generate_plot(
+            metadata,
+            metrics[spec['metrics']],
+            spec['x_dim'],
+            spec['y_dim'],
+            spec['cols'],
+            spec['rows'],
+            spec['title'],
+            spec['plot_level'],
+            figure_cache,
+            spec['max_points'],
+            donor_frames
+        )
+    return(plots)
+
+def metrics_store_name(metrics_key):
+    return(metrics_key.replace(":","_")+".parquet")
+
+def columnar_frame(frame):
+    """
+    Parquet needs one type per column; object columns holding mixed values
+    (e.g. verifyBamHomChk fields) are stored as strings.
+    """
+    frame=frame.copy()
+    for column in frame.columns[frame.dtypes==object]:
+        if pd.api.types.infer_dtype(frame[column],skipna=True) not in ['string','empty']:
+            frame[column]=frame[column].map(lambda value:value if pd.isnull(value) else str(value))
+    return(frame)
 
-def generate_plot(metadata,metrics,x_dim,y_dim,cols,rows,title,plot_level):
+def save_plot_specs(out_dir,metadata,metrics,specs):
+    """
+    Write the metadata and each plotted metrics table once as parquet, plus
+    one small JSON spec per figure that load_figure rebuilds on demand.
+    """
+    print("Saving plot specs...")
+    data_dir="%s/%s" % (out_dir,"data")
+    spec_dir="%s/%s" % (out_dir,"spec")
+    for directory in [data_dir,spec_dir]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    columnar_frame(metadata).to_parquet("%s/%s" % (data_dir,"metadata.parquet"))
+    for key in set([spec['metrics'] for spec in specs.values()]):
+        columnar_frame(metrics[key]).to_parquet("%s/%s" % (data_dir,metrics_store_name(key)))
+    for name,spec in specs.items():
+        with open("%s/%s.json" % (spec_dir,name),"w") as file:
+            json.dump(dict(spec,metrics_file="data/%s" % metrics_store_name(spec['metrics']),metadata_file="data/metadata.parquet"),file,indent=2)
+    print("Saving plot specs...Complete")
+
+def load_figure(spec_path):
+    """
+    Rebuild one figure from its spec, reading only the columns it plots.
+    """
+    with open(spec_path) as file:
+        spec=json.load(file)
+    out_dir=os.path.dirname(os.path.dirname(os.path.abspath(spec_path)))
+    metrics=pd.read_parquet("%s/%s" % (out_dir,spec['metrics_file']),columns=["sampleId","PIPELINE"]+spec['rows'])
+    metadata=None
+    if spec['plot_level']!='sample':
+        metadata=pd.read_parquet(
+            "%s/%s" % (out_dir,spec['metadata_file']),
+            columns=["sampleId","matchedNormalSampleId","donorId","tumourNormalDesignation"]
+        )
+    return(generate_plot(metadata,metrics,spec['x_dim'],spec['y_dim'],spec['cols'],spec['rows'],spec['title'],spec['plot_level'],max_points=spec.get('max_points',0)))
+
+def save_html_report(report_path,title,plots,metadata,metrics,specs,webgl_threshold):
+    """
+    One HTML file with plotly.js embedded once and a div per figure. Figures
+    skipped by the figure cache are rebuilt from their spec.
+    """
+    print("Saving HTML report...")
+    sections=[]
+    donor_frames={}
+    for name,spec in specs.items():
+        fig=plots.get(name)
+        if fig is None:
+            fig=generate_plot(
+                metadata,
+                metrics[spec['metrics']],
+                spec['x_dim'],
+                spec['y_dim'],
+                spec['cols'],
+                spec['rows'],
+                spec['title'],
+                spec['plot_level'],
+                max_points=spec['max_points'],
+                donor_frames=donor_frames
+            )
+        sections.append((name,spec['title'],plotly.io.to_html(webgl_figure(fig,webgl_threshold),full_html=False,include_plotlyjs=False,div_id=name)))
+
+    with open(report_path,"w") as file:
+        file.write("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\"/>\n<title>%s</title>\n" % html.escape(title))
+        file.write("<script type=\"text/javascript\">%s</script>\n</head>\n<body>\n" % plotly.offline.get_plotlyjs())
+        file.write("<h1>%s</h1>\n<ul>\n" % html.escape(title))
+        for name,section_title,section in sections:
+            file.write("<li><a href=\"#%s\">%s</a></li>\n" % (name,html.escape(section_title)))
+        file.write("</ul>\n")
+        for name,section_title,section in sections:
+            file.write("%s\n" % section)
+        file.write("</body>\n</html>\n")
+    print("Saving HTML report...Complete")
+
+def webgl_figure(fig,webgl_threshold):
+    """
+    Copy of fig with every scatter trace above webgl_threshold points drawn as Scattergl.
+    """
+    if all([trace.type!='scatter' or trace.x is None or len(trace.x)<=webgl_threshold for trace in fig.data]):
+        return(fig)
+    fig=go.Figure(fig)
+    traces=[]
+    for trace in fig.data:
+        if trace.type=='scatter' and trace.x is not None and len(trace.x)>webgl_threshold:
+            trace_json=trace.to_plotly_json()
+            trace_json.pop('type')
+            trace=go.Scattergl(trace_json)
+        traces.append(trace)
+    fig.data=[]
+    fig.add_traces(traces)
+    return(fig)
+
+def start_image_renderer():
+    ###Render a blank figure so kaleido starts once per process instead of on the first real figure
+    go.Figure().to_image(format="svg")
+
+def export_image(export):
+    fig,path,image_format=export
+    start=time.time()
+    fig.write_image(path,format=image_format)
+    return(path,image_format,time.time()-start)
+
+def print_export_summary(timings,wall_time):
+    print("Exported %s images in %.2fs" % (len(timings),wall_time))
+    for image_format in sorted(set([timing[1] for timing in timings])):
+        durations=[timing[2] for timing in timings if timing[1]==image_format]
+        print("  %s : %s images, %.2fs render time, %.3fs mean" % (image_format,len(durations),sum(durations),sum(durations)/len(durations)))
+    slowest=max(timings,key=lambda timing:timing[2])
+    print("  slowest : %s (%.2fs)" % (slowest[0],slowest[2]))
+
+@profiler.profiled("generate_plot",lambda fig:{"figures":1} if fig is not None else {"unchanged":1})
+def generate_plot(metadata,metrics,x_dim,y_dim,cols,rows,title,plot_level,figure_cache=None,max_points=0,donor_frames=None):
+    if figure_cache is not None:
+        key=figure_key(metadata,metrics,x_dim,y_dim,cols,rows,title,plot_level,max_points)
+        if figure_cache.fresh(key):
+            print("Plot unchanged for %s" % (title))
+            return(None)
     if plot_level=='sample':
-        return(generate_sample_plot(metrics,x_dim,y_dim,cols,rows,title))
+        fig=generate_sample_plot(metrics,x_dim,y_dim,cols,rows,title,max_points)
     else:
-        return(generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title))
+        fig=generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title,donor_frames)
+    if figure_cache is not None:
+        figure_cache.stage(fig,key)
+    return(fig)
 
-def generate_sample_plot(metrics,x_dim,y_dim,cols,rows,title):
+def figure_key(metadata,metrics,x_dim,y_dim,cols,rows,title,plot_level,max_points=0):
+    """
+    Hash of the data slice a figure is drawn from plus its plot parameters.
+    """
+    digest=hashlib.sha1(repr((title,cols,rows,plot_level,x_dim,y_dim,max_points if plot_level=='sample' else 0)).encode())
+    data=metrics.loc[metrics['PIPELINE'].isin(cols),["sampleId","PIPELINE"]+rows]
+    digest.update(pd.util.hash_pandas_object(data,index=True).values.tobytes())
+    if plot_level!='sample':
+        ids=metadata.loc[:,["sampleId","matchedNormalSampleId","donorId","tumourNormalDesignation"]]
+        digest.update(pd.util.hash_pandas_object(ids,index=False).values.tobytes())
+    return(digest.hexdigest())
+
+class FigureCache:
+    """
+    Per output directory record of figure hashes and the files written for
+    them. A figure is fresh when its hash is recorded and every file it needs
+    (pkl or spec, plus each requested image format) is still on disk.
+    """
+    def __init__(self,out_dir,image_formats,plot_store='pkl'):
+        self.path="%s/%s" % (out_dir,"figure_cache.json")
+        self.image_formats=[image_format for image_format in image_formats if image_format!='none']
+        self.store_extension=".pkl" if plot_store=='pkl' else ".json"
+        self.pending={}
+        self.figures={}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.figures=json.load(file)
+
+    def fresh(self,key):
+        figure=self.figures.get(key)
+        if figure is None:
+            return(False)
+        extensions=[os.path.splitext(path)[1] for path in figure['files'] if os.path.exists(path)]
+        return(all([extension in extensions for extension in [self.store_extension]+["."+image_format for image_format in self.image_formats]]))
+
+    def stage(self,fig,key):
+        self.pending[id(fig)]=key
+
+    def commit(self,fig,files):
+        key=self.pending.pop(id(fig),None)
+        if key is None:
+            return
+        ###Files are overwritten in place, so older hashes pointing at them are no longer valid
+        for stale in [stale for stale,figure in self.figures.items() if set(figure['files'])&set(files)]:
+            del self.figures[stale]
+        self.figures[key]={"title":fig.layout.title.text,"files":files}
+
+    def save(self):
+        with open(self.path+".tmp","w") as file:
+            json.dump(self.figures,file,indent=2)
+        os.replace(self.path+".tmp",self.path)
+
+def downsample_sorted(count,max_points):
+    """
+    Positions to keep from a sorted curve of count points : evenly spaced
+    ranks, always including both ends. Samples sit on a categorical axis, so
+    even rank spacing keeps the curve's shape.
+    """
+    if max_points<=0 or count<=max_points:
+        return(None)
+    return(np.unique(np.linspace(0,count-1,max(max_points,2)).round().astype(int)))
+
+def generate_sample_plot(metrics,x_dim,y_dim,cols,rows,title,max_points=0):
     print("Generating plot for %s" % (title))
     fig=plotly.subplots.make_subplots(
         cols=len(cols),
@@ -318,34 +658,44 @@ def generate_sample_plot(metrics,x_dim,y_dim,cols,rows,title):
         subplot_titles=cols
     )
     
+    pipelines={pipeline:group for pipeline,group in metrics.groupby("PIPELINE",sort=False)}
+    traces=[]
+    trace_rows=[]
+    trace_cols=[]
     for row_ind,row in enumerate(rows):
         for col_ind,col in enumerate(cols):
-            fig.append_trace(
+            ###Each pipeline x metric slice is sorted once and shared by every trace below
+            subset=pipelines[col].sort_values(row) if col in pipelines else metrics.iloc[0:0]
+            samples=subset['sampleId'].values.tolist()
+            values=subset[row].values.tolist()
+            ###Percentiles below always use every value, only the drawn curve is thinned
+            keep=downsample_sorted(len(samples),max_points)
+            traces.append(
                 go.Scatter(
-                    x=metrics.query("PIPELINE==@col").sort_values(row)['sampleId'].values.tolist(),
-                    y=metrics.query("PIPELINE==@col").sort_values(row)[row].values.tolist(),
+                    x=samples if keep is None else subset['sampleId'].values[keep].tolist(),
+                    y=values if keep is None else subset[row].values[keep].tolist(),
                     mode='markers+lines',
-                    showlegend=False),
-                row_ind+1,
-                col_ind+1
+                    showlegend=False)
             )
-            
-            for val in [25,5,75]:
-                fig.append_trace(
+            trace_rows.append(row_ind+1)
+            trace_cols.append(col_ind+1)
+            if len(samples)==0:
+                continue
+
+            for percentile in np.percentile(values,[25,5,75],axis=0):
+                traces.append(
                     go.Scatter(
-                        x=[
-                            metrics.query("PIPELINE==@col").sort_values(row)['sampleId'].values.tolist()[0],
-                            metrics.query("PIPELINE==@col").sort_values(row)['sampleId'].values.tolist()[-1]
-                        ],
-                        y=[np.percentile(metrics.query("PIPELINE==@col").sort_values(row)[row].values.tolist(),val,axis=0)]*2,
+                        x=[samples[0],samples[-1]],
+                        y=[percentile]*2,
                         mode='lines',
                         line=dict(dash="dash",color="black"),
                         opacity=0.3,
-                        showlegend=False),
-                    row_ind+1,
-                    col_ind+1
+                        showlegend=False)
                 )
-                
+                trace_rows.append(row_ind+1)
+                trace_cols.append(col_ind+1)
+    fig.add_traces(traces,rows=trace_rows,cols=trace_cols)
+
     fig['layout'].update(
         width=x_dim,
         height=y_dim,
@@ -357,29 +707,74 @@ def generate_sample_plot(metrics,x_dim,y_dim,cols,rows,title):
     )
     return(fig)
 
-def generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title):
+def prepare_donor_metrics(metadata,metrics,donor_frames=None):
+    """
+    Join every tumour sample to its matched normal once per metrics frame.
+    Per pipeline : tumour rows in metadata order, the tumour and normal metric
+    values aligned to them, and a lazily filled per-metric sort order.
+    donor_frames, if given, keeps the result for later figures of the same
+    (metadata,metrics) pair; its owner decides how long they live.
+    """
+    if donor_frames is not None:
+        cached=donor_frames.get((id(metadata),id(metrics)))
+        if cached is not None and cached[0] is metadata and cached[1] is metrics:
+            return(cached[2])
+
+    tumours=metadata.loc[metadata['tumourNormalDesignation']=='Tumour',["sampleId","matchedNormalSampleId","donorId"]].drop_duplicates()
+    prepared={}
+    for pipeline,pipeline_metrics in metrics.groupby("PIPELINE",sort=False):
+        values=pipeline_metrics.drop_duplicates("sampleId").set_index("sampleId")
+        pipeline_tumours=tumours.loc[tumours['sampleId'].isin(values.index)].reset_index(drop=True)
+        prepared[pipeline]={
+            "tumours":pipeline_tumours,
+            "tumour_values":values.reindex(pipeline_tumours['sampleId'].values).reset_index(drop=True),
+            "normal_values":values.reindex(pipeline_tumours['matchedNormalSampleId'].values).reset_index(drop=True),
+            "has_normal":pipeline_tumours['matchedNormalSampleId'].isin(values.index).values,
+            "order":{}
+        }
+    if donor_frames is not None:
+        donor_frames[(id(metadata),id(metrics))]=(metadata,metrics,prepared)
+    return(prepared)
+
+def donor_metric_values(prepared,row):
+    """
+    Donor ids, tumour values and normal values (None where no normal) for one
+    metric, ordered by tumour value.
+    """
+    if row not in prepared['order']:
+        prepared['order'][row]=prepared['tumour_values'][row].sort_values().index.values
+    order=prepared['order'][row]
+    donors=prepared['tumours']['donorId'].values[order].tolist()
+    tumour_values=prepared['tumour_values'][row].values[order]
+    normal_values=prepared['normal_values'][row].values[order]
+    has_normal=prepared['has_normal'][order]
+    return(
+        donors,
+        tumour_values,
+        [value if present else None for value,present in zip(normal_values.tolist(),has_normal)],
+        normal_values[has_normal]
+    )
+
+def generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title,donor_frames=None):
     print("Generating plot for %s" % (title))
     fig=plotly.subplots.make_subplots(
         cols=len(cols),
         rows=len(rows),
         subplot_titles=cols
     )
+    prepared=prepare_donor_metrics(metadata,metrics,donor_frames)
 
     for row_ind,row in enumerate(rows):
         for col_ind,col in enumerate(cols):
-            samples=metrics.query("PIPELINE==@col")['sampleId'].values.tolist()
-            ###Return tumour samples
-            subset_metadata=metadata.query("sampleId==@samples and tumourNormalDesignation=='Tumour'").loc[:,["sampleId","matchedNormalSampleId","donorId"]].drop_duplicates().set_index("sampleId")
-            ###Reorder tumour samples according to metric value
-            subset_metadata=subset_metadata.loc[metrics.set_index("sampleId").loc[subset_metadata.index.values.tolist(),row].sort_values().index.values.tolist(),:]
-            ###Return metric value for tumour and normal samples
-            tumour_values=metrics.set_index("sampleId").loc[subset_metadata.index.values.tolist(),row].values.tolist()
-            normal_values=[metrics.set_index("sampleId").loc[ind,row] if ind in metrics.set_index("sampleId").index else None for ind in subset_metadata['matchedNormalSampleId'].values.tolist()]
-            
+            if col not in prepared:
+                continue
+            ###Tumour samples ordered by metric value, with the matched normal value alongside
+            donors,tumour_values,normal_values,present_normal_values=donor_metric_values(prepared[col],row)
+
             ###Plot donor vs metrics from normal
             fig.append_trace(
                 go.Scatter(
-                    x=subset_metadata['donorId'].values.tolist(),
+                    x=donors,
                     y=normal_values,
                     mode='markers+lines',
                     name='Normal',
@@ -391,8 +786,8 @@ def generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title):
             ###Plot donor vs metrics from tumour
             fig.append_trace(
                 go.Scatter(
-                    x=subset_metadata['donorId'].values.tolist(),
-                    y=tumour_values,
+                    x=donors,
+                    y=tumour_values.tolist(),
                     mode='markers+lines',
                     name='Tumour',
                     line=dict(dash="dash",color="red"),
@@ -400,15 +795,16 @@ def generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title):
                 row_ind+1,
                 col_ind+1
             )
-            for val in [25,50,75]:
+            if len(donors)==0:
+                continue
+            tumour_percentiles=np.percentile(tumour_values,[25,50,75],axis=0)
+            normal_percentiles=np.percentile(present_normal_values,[25,50,75],axis=0) if len(present_normal_values)>0 else None
+            for val_ind,val in enumerate([25,50,75]):
                 ###Print percentiles for tumours
                 fig.append_trace(
                     go.Scatter(
-                        x=[
-                            subset_metadata['donorId'].values.tolist()[0],
-                            subset_metadata['donorId'].values.tolist()[-1]
-                        ],
-                        y=[np.percentile([z for z in tumour_values if z!=None],val,axis=0)]*2,
+                        x=[donors[0],donors[-1]],
+                        y=[tumour_percentiles[val_ind]]*2,
                         mode='lines',
                         line=dict(dash="dash",color="black"),
                         opacity=0.6,
@@ -418,13 +814,12 @@ def generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title):
                     col_ind+1
                 )
                 ###Print percentiles for normals
+                if normal_percentiles is None:
+                    continue
                 fig.append_trace(
                     go.Scatter(
-                        x=[
-                            subset_metadata['donorId'].values.tolist()[0],
-                            subset_metadata['donorId'].values.tolist()[-1]
-                        ],
-                        y=[np.percentile([z for z in normal_values if z!=None],val,axis=0)]*2,
+                        x=[donors[0],donors[-1]],
+                        y=[normal_percentiles[val_ind]]*2,
                         mode='lines',
                         line=dict(dash="dot",color="black"),
                         opacity=0.4,
@@ -445,50 +840,86 @@ def generate_donor_plot(metadata,metrics,x_dim,y_dim,cols,rows,title):
     )
     return(fig)
 
-def aggregate_gatk_quality_yield_metrics(response,analysis_exclude_list,debug):
+class MetricsBuilder:
+    """
+    Collect metric cells into per-column buffers and build the DataFrame once.
+    Mirrors the dtypes of the old cell-by-cell metrics.loc[id,col]=value growth:
+    columns hold floats until a non-numeric value arrives, then become object.
+    """
+    def __init__(self):
+        self.rows={}
+        self.columns={}
+        self.numeric={}
+
+    def set(self,row_id,column,value):
+        row=self.rows.get(row_id)
+        if row is None:
+            row=self.rows[row_id]=len(self.rows)
+            for buffer in self.columns.values():
+                buffer.append(None)
+        if column not in self.columns:
+            self.columns[column]=[None]*len(self.rows)
+            self.numeric[column]=True
+
+        if value is None:
+            pass
+        elif isinstance(value,(int,float,np.number)) and not isinstance(value,(bool,np.bool_)):
+            if self.numeric[column]:
+                value=float(value)
+        else:
+            self.numeric[column]=False
+        self.columns[column][row]=value
+
+    def to_frame(self):
+        if len(self.rows)==0:
+            return(pd.DataFrame())
+        data={}
+        for column,buffer in self.columns.items():
+            if self.numeric[column]:
+                data[column]=np.array([np.nan if value is None else value for value in buffer],dtype=np.float64)
+            else:
+                data[column]=pd.Series([np.nan if value is None else value for value in buffer],dtype=object).values
+        return(pd.DataFrame(data,index=pd.Index(list(self.rows.keys()),dtype=object)))
+
+@profiler.profiled("aggregate_gatk_quality_yield_metrics",lambda metrics:{"rows":len(metrics)})
+def aggregate_gatk_quality_yield_metrics(index,analysis_exclude_list,debug):
     print("Aggregating metrics from : %s" % ('Picard:CollectQualityYieldMetrics'))
-    metrics=pd.DataFrame()
+    metrics=MetricsBuilder()
     debug=False
     analysis_exclude_list=None
-    for count,analysis in enumerate(response.json()):
+    for count,analysis,file in index['tool'].get('Picard:CollectQualityYieldMetrics',[]):
         if analysis_exclude_list!=None:
             if analysis['analysisId'] in analysis_exclude_list:
                 continue
         if count%50==0 and debug:
             print(count)
-        for file in analysis['files']:
-            if file['info'].get('analysis_tools'):
-                if file['info']['analysis_tools'][0]=='Picard:CollectQualityYieldMetrics':
-                    
-                    sampleId=analysis['samples'][0]['sampleId']
-                    readGroupId=file['info']['metrics']['read_group_id']
-                    uniqueId=sampleId+"."+readGroupId
-                    
-                    if "star" in file['fileName']:
-                        metrics.loc[uniqueId,"PIPELINE"]="STAR"
-                    elif "hisat2" in file['fileName']:
-                        metrics.loc[uniqueId,"PIPELINE"]="HISAT2"
-                    else :
-                        metrics.loc[uniqueId,"PIPELINE"]="BWA-MEM"
-                        
-
-                    metrics.loc[uniqueId,"sampleId"]=analysis['samples'][0]['sampleId']
-                    metrics.loc[uniqueId,"readGroupId"]=file['info']['metrics']['read_group_id']
-                    metrics.loc[uniqueId,"analysisId"]=analysis['analysisId']
-                    metrics.loc[uniqueId,"objectId"]=file['objectId']
-
-                    for query in [
-                        "total_reads",
-                        "read_length",
-                        'pf_reads'
-                    ]:
-                        if query in file['info']['metrics']:
-                            metrics.loc[uniqueId,query]=file['info']['metrics'][query]
-                        else:
-                            print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
-                            metrics.loc[uniqueId,query]=None
+        sampleId=analysis['samples'][0]['sampleId']
+        readGroupId=file['info']['metrics']['read_group_id']
+        uniqueId=sampleId+"."+readGroupId
+
+        if "star" in file['fileName']:
+            metrics.set(uniqueId,"PIPELINE","STAR")
+        elif "hisat2" in file['fileName']:
+            metrics.set(uniqueId,"PIPELINE","HISAT2")
+        else :
+            metrics.set(uniqueId,"PIPELINE","BWA-MEM")
+
+        metrics.set(uniqueId,"sampleId",analysis['samples'][0]['sampleId'])
+        metrics.set(uniqueId,"readGroupId",file['info']['metrics']['read_group_id'])
+        metrics.set(uniqueId,"analysisId",analysis['analysisId'])
+        metrics.set(uniqueId,"objectId",file['objectId'])
+
+        for query in [
+            "total_reads",
+            "read_length",
+            'pf_reads'
+        ]:
+            if query in file['info']['metrics']:
+                metrics.set(uniqueId,query,file['info']['metrics'][query])
             else:
-                continue
+                print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
+                metrics.set(uniqueId,query,None)
+    metrics=metrics.to_frame()
 
     if debug:
         print(metrics)
@@ -498,47 +929,44 @@ def aggregate_gatk_quality_yield_metrics(response,analysis_exclude_list,debug):
 
     return(metrics)
 
-def aggregate_samtools_stats_metrics(response,analysis_exclude_list,debug):
+@profiler.profiled("aggregate_samtools_stats_metrics",lambda metrics:{"rows":len(metrics)})
+def aggregate_samtools_stats_metrics(index,analysis_exclude_list,debug):
     print("Aggregating metrics from : %s" % ('Samtools:stats'))
-    metrics=pd.DataFrame()
+    metrics=MetricsBuilder()
     #total=len([response.json()[int(ind)] for ind in metadata_df.query("analysisId!=@analysis_exclude_list")["ind"].values.tolist()])
-    for count,analysis in enumerate(response.json()):
+    for count,analysis,file in index['tool'].get('Samtools:stats',[]):
         if analysis_exclude_list!=None:
             if analysis['analysisId'] in analysis_exclude_list:
                 continue
         if count%50==0 and debug:
             print(count)
-        for file in analysis['files']:
-            if file['info'].get('analysis_tools'):
-                if file['info']['analysis_tools'][0]=='Samtools:stats':
-                    metrics.loc[analysis['analysisId'],'sampleId']=analysis['samples'][0]['sampleId']
-                    if "star" in file['fileName']:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="STAR"
-                    elif "hisat2" in file['fileName']:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="HISAT2"
-                    else :
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="BWA-MEM"
-                    for query in [
-                        "average_insert_size",
-                        "average_length",
-                        "duplicated_bases",
-                        "error_rate",
-                        "mapped_bases_cigar",
-                        "mapped_reads",
-                        "mismatch_bases",
-                        "paired_reads",
-                        "pairs_on_different_chromosomes",
-                        "properly_paired_reads",
-                        "total_bases",
-                        "total_reads",
-                    ]:
-                        if query in file['info']['metrics']:
-                            metrics.loc[analysis['analysisId'],query]=file['info']['metrics'][query]
-                        else:
-                            print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
-                            metrics.loc[analysis['analysisId'],query]=None
+        metrics.set(analysis['analysisId'],'sampleId',analysis['samples'][0]['sampleId'])
+        if "star" in file['fileName']:
+            metrics.set(analysis['analysisId'],"PIPELINE","STAR")
+        elif "hisat2" in file['fileName']:
+            metrics.set(analysis['analysisId'],"PIPELINE","HISAT2")
+        else :
+            metrics.set(analysis['analysisId'],"PIPELINE","BWA-MEM")
+        for query in [
+            "average_insert_size",
+            "average_length",
+            "duplicated_bases",
+            "error_rate",
+            "mapped_bases_cigar",
+            "mapped_reads",
+            "mismatch_bases",
+            "paired_reads",
+            "pairs_on_different_chromosomes",
+            "properly_paired_reads",
+            "total_bases",
+            "total_reads",
+        ]:
+            if query in file['info']['metrics']:
+                metrics.set(analysis['analysisId'],query,file['info']['metrics'][query])
             else:
-                continue
+                print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
+                metrics.set(analysis['analysisId'],query,None)
+    metrics=metrics.to_frame()
 
     if debug:
         print(metrics)
@@ -548,64 +976,61 @@ def aggregate_samtools_stats_metrics(response,analysis_exclude_list,debug):
 
     return(metrics)
 
-def aggregate_sanger_compareBamGenotypes_metrics(response,analysis_exclude_list,debug):
+@profiler.profiled("aggregate_sanger_compareBamGenotypes_metrics",lambda metrics:{"rows":len(metrics)})
+def aggregate_sanger_compareBamGenotypes_metrics(index,analysis_exclude_list,debug):
     print("Aggregating metrics from : %s" % ('Sanger:compareBamGenotypes'))
-    metrics=pd.DataFrame()
+    metrics=MetricsBuilder()
     debug=False
     analysis_exclude_list=None
-    for count,analysis in enumerate(response.json()):
-            if analysis_exclude_list!=None:
-                if analysis['analysisId'] in analysis_exclude_list:
-                    continue
-            if count%50==0 and debug:
-                print(count)
-            for file in analysis['files']:
-                if file['info'].get('analysis_tools'):
-                    if file['info']['analysis_tools'][0]=='Sanger:compareBamGenotypes':
-                        if file['info'].get('metrics'):
-
-                            if "star" in file['fileName']:
-                                metrics.loc[analysis['analysisId'],"PIPELINE"]="STAR"
-                            elif "hisat2" in file['fileName']:
-                                metrics.loc[analysis['analysisId'],"PIPELINE"]="HISAT2"
-                            else :
-                                metrics.loc[analysis['analysisId'],"PIPELINE"]="BWA-MEM"
-
-                            metrics.loc[analysis['analysisId'],"sampleId"]=analysis['samples'][0]['sampleId']
-
-                            for query in [
-                                'frac_match_gender',
-                                'gender'
-                            ]:
-                                if query in file['info']['metrics']['tumours'][0]['gender']:
-                                    metrics.loc[analysis['analysisId'],query]=file['info']['metrics']['tumours'][0]['gender'][query]
-                                else:
-                                    print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
-                                    metrics.loc[analysis['analysisId'],query]=None
-
-                            for query in [
-                                'compared_against',
-                                'total_loci_gender',
-                                'total_loci_genotype'
-                            ]:
-                                if query in file['info']['metrics']:
-                                    metrics.loc[analysis['analysisId'],query]=file['info']['metrics'][query]
-                                else:
-                                    print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
-                                    metrics.loc[analysis['analysisId'],query]=None
-
-                            for query in [
-                                'frac_informative_genotype',
-                                'frac_matched_genotype'
-
-                            ]:
-                                if query in file['info']['metrics']['tumours'][0]['genotype']:
-                                    metrics.loc[analysis['analysisId'],query]=file['info']['metrics']['tumours'][0]['genotype'][query]
-                                else:
-                                    print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
-                                    metrics.loc[analysis['analysisId'],query]=None
-            else:
+    for count,analysis,file in index['tool'].get('Sanger:compareBamGenotypes',[]):
+        if analysis_exclude_list!=None:
+            if analysis['analysisId'] in analysis_exclude_list:
                 continue
+        if count%50==0 and debug:
+            print(count)
+        if file['info'].get('metrics'):
+
+            if "star" in file['fileName']:
+                metrics.set(analysis['analysisId'],"PIPELINE","STAR")
+            elif "hisat2" in file['fileName']:
+                metrics.set(analysis['analysisId'],"PIPELINE","HISAT2")
+            else :
+                metrics.set(analysis['analysisId'],"PIPELINE","BWA-MEM")
+
+            metrics.set(analysis['analysisId'],"sampleId",analysis['samples'][0]['sampleId'])
+
+            for query in [
+                'frac_match_gender',
+                'gender'
+            ]:
+                if query in file['info']['metrics']['tumours'][0]['gender']:
+                    metrics.set(analysis['analysisId'],query,file['info']['metrics']['tumours'][0]['gender'][query])
+                else:
+                    print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
+                    metrics.set(analysis['analysisId'],query,None)
+
+            for query in [
+                'compared_against',
+                'total_loci_gender',
+                'total_loci_genotype'
+            ]:
+                if query in file['info']['metrics']:
+                    metrics.set(analysis['analysisId'],query,file['info']['metrics'][query])
+                else:
+                    print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
+                    metrics.set(analysis['analysisId'],query,None)
+
+            for query in [
+                'frac_informative_genotype',
+                'frac_matched_genotype'
+
+            ]:
+                if query in file['info']['metrics']['tumours'][0]['genotype']:
+                    metrics.set(analysis['analysisId'],query,file['info']['metrics']['tumours'][0]['genotype'][query])
+                else:
+                    print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
+                    metrics.set(analysis['analysisId'],query,None)
+    metrics=metrics.to_frame()
 
     if debug:
         print(metrics)
@@ -615,36 +1040,34 @@ def aggregate_sanger_compareBamGenotypes_metrics(response,analysis_exclude_list,
 
     return(metrics)
 
-def aggregate_sanger_verifyBamHomChk_metrics(response,analysis_exclude_list,debug):
+@profiler.profiled("aggregate_sanger_verifyBamHomChk_metrics",lambda metrics:{"rows":len(metrics)})
+def aggregate_sanger_verifyBamHomChk_metrics(index,analysis_exclude_list,debug):
     print("Aggregating metrics from : %s" % ('Sanger:verifyBamHomChk'))
-    metrics=pd.DataFrame()
+    metrics=MetricsBuilder()
     debug=False
     analysis_exclude_list=None
-    for count,analysis in enumerate(response.json()):
-            if analysis_exclude_list!=None:
-                if analysis['analysisId'] in analysis_exclude_list:
-                    continue
-            if count%50==0 and debug:
-                print(count)
-            for file in analysis['files']:
-                if file['info'].get('analysis_tools'):
-                    if file['info']['analysis_tools'][0]=='Sanger:verifyBamHomChk':
-                        if file['info'].get('metrics'):
-                            metrics.loc[analysis['analysisId'],"sampleId"]=analysis['samples'][0]['sampleId']
-                            if "star" in file['fileName']:
-                                metrics.loc[analysis['analysisId'],"PIPELINE"]="STAR"
-                            elif "hisat2" in file['fileName']:
-                                metrics.loc[analysis['analysisId'],"PIPELINE"]="HISAT2"
-                            else :
-                                metrics.loc[analysis['analysisId'],"PIPELINE"]="BWA-MEM"
-                                
-                            for key in file['info']['metrics'].keys():
-                                if key=='sample_id':
-                                    continue
-                                else:
-                                    metrics.loc[analysis['analysisId'],key]=file['info']['metrics'][key]
-            else:
+    for count,analysis,file in index['tool'].get('Sanger:verifyBamHomChk',[]):
+        if analysis_exclude_list!=None:
+            if analysis['analysisId'] in analysis_exclude_list:
                 continue
+        if count%50==0 and debug:
+            print(count)
+        if file['info'].get('metrics'):
+            metrics.set(analysis['analysisId'],"sampleId",analysis['samples'][0]['sampleId'])
+            if "star" in file['fileName']:
+                metrics.set(analysis['analysisId'],"PIPELINE","STAR")
+            elif "hisat2" in file['fileName']:
+                metrics.set(analysis['analysisId'],"PIPELINE","HISAT2")
+            else :
+                metrics.set(analysis['analysisId'],"PIPELINE","BWA-MEM")
+
+            for key in file['info']['metrics'].keys():
+                if key=='sample_id':
+                    continue
+                else:
+                    metrics.set(analysis['analysisId'],key,file['info']['metrics'][key])
+
+    metrics=metrics.to_frame()
     if debug:
         print(metrics)
 
@@ -653,37 +1076,34 @@ def aggregate_sanger_verifyBamHomChk_metrics(response,analysis_exclude_list,debu
 
     return(metrics)
 
-def aggregate_gatk_oxo_metrics(response,analysis_exclude_list,debug):
+@profiler.profiled("aggregate_gatk_oxo_metrics",lambda metrics:{"rows":len(metrics)})
+def aggregate_gatk_oxo_metrics(index,analysis_exclude_list,debug):
     print("Aggregating metrics from : %s" % ('GATK:CollectOxoGMetrics'))
-    metrics=pd.DataFrame()
+    metrics=MetricsBuilder()
     #total=len([response.json()[int(ind)] for ind in metadata_df.query("analysisId!=@analysis_exclude_list")["ind"].values.tolist()])
-    for count,analysis in enumerate(response.json()):
+    for count,analysis,file in index['tool'].get('GATK:CollectOxoGMetrics',[]):
         if analysis_exclude_list!=None:
             if analysis['analysisId'] in analysis_exclude_list:
                 continue
         if count%50==0 and debug:
             print(count)
-        for file in analysis['files']:
-            if file['info'].get('analysis_tools'):
-                if file['info']['analysis_tools'][0]=='GATK:CollectOxoGMetrics':
-                    metrics.loc[analysis['analysisId'],'sampleId']=analysis['samples'][0]['sampleId']
-                    if "star" in file['fileName']:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="STAR"
-                    elif "hisat2" in file['fileName']:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="HISAT2"
-                    else :
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="BWA-MEM"
-                    for query in [
-                                'oxoQ_score'
-                    ]:
-                        if query in file['info']['metrics']:
-                            metrics.loc[analysis['analysisId'],query]=file['info']['metrics'][query]
-                        else:
-                            print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
-                            metrics.loc[analysis['analysisId'],query]=None
-
+        metrics.set(analysis['analysisId'],'sampleId',analysis['samples'][0]['sampleId'])
+        if "star" in file['fileName']:
+            metrics.set(analysis['analysisId'],"PIPELINE","STAR")
+        elif "hisat2" in file['fileName']:
+            metrics.set(analysis['analysisId'],"PIPELINE","HISAT2")
+        else :
+            metrics.set(analysis['analysisId'],"PIPELINE","BWA-MEM")
+        for query in [
+                    'oxoQ_score'
+        ]:
+            if query in file['info']['metrics']:
+                metrics.set(analysis['analysisId'],query,file['info']['metrics'][query])
             else:
-                continue
+                print("Analysis %s is missing field %s" % (analysis['analysisId'],query))
+                metrics.set(analysis['analysisId'],query,None)
+
+    metrics=metrics.to_frame()
 
     if debug:
         print(metrics)
@@ -693,39 +1113,35 @@ def aggregate_gatk_oxo_metrics(response,analysis_exclude_list,debug):
 
     return(metrics)
 
-def aggregate_picard_mark_duplicates_metrics(response,analysis_exclude_list,debug):
+@profiler.profiled("aggregate_picard_mark_duplicates_metrics",lambda metrics:{"rows":len(metrics)})
+def aggregate_picard_mark_duplicates_metrics(index,analysis_exclude_list,debug):
     print("Aggregating metrics from : %s" % ('biobambam2:bammarkduplicates2'))
-    metrics=pd.DataFrame()
+    metrics=MetricsBuilder()
     #total=len([response.json()[int(ind)] for ind in metadata_df.query("analysisId!=@analysis_exclude_list")["ind"].values.tolist()])
-    for count,analysis in enumerate(response.json()):
+    for count,analysis,file in index['tool'].get('biobambam2:bammarkduplicates2',[]):
         if analysis_exclude_list!=None:
             if analysis['analysisId'] in analysis_exclude_list:
                 continue
         if count%50==0 and debug:
             print(count)
-        for file in analysis['files']:
-            if file['info'].get('analysis_tools'):
-                if file['info']['analysis_tools'][0]=='biobambam2:bammarkduplicates2':
-                    metrics.loc[analysis['analysisId'],'sampleId']=analysis['samples'][0]['sampleId']
-                    if "star" in file['fileName']:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="STAR"
-                    elif "hisat2" in file['fileName']:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="HISAT2"
-                    else :
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="BWA-MEM"
-                    for query in [
-                                'READ_PAIRS_EXAMINED',
-                                'READ_PAIR_DUPLICATES',
-                                'READ_PAIR_OPTICAL_DUPLICATES',
-                                'UNMAPPED_READS',
-                                'UNPAIRED_READS_EXAMINED',
-                                'UNPAIRED_READ_DUPLICATES'
-                    ]:
-                        metrics.loc[analysis['analysisId'],query]=sum(z[query] for z in file['info']['metrics']['libraries'])
-            else:
-                continue
-
-
+        metrics.set(analysis['analysisId'],'sampleId',analysis['samples'][0]['sampleId'])
+        if "star" in file['fileName']:
+            metrics.set(analysis['analysisId'],"PIPELINE","STAR")
+        elif "hisat2" in file['fileName']:
+            metrics.set(analysis['analysisId'],"PIPELINE","HISAT2")
+        else :
+            metrics.set(analysis['analysisId'],"PIPELINE","BWA-MEM")
+        for query in [
+                    'READ_PAIRS_EXAMINED',
+                    'READ_PAIR_DUPLICATES',
+                    'READ_PAIR_OPTICAL_DUPLICATES',
+                    'UNMAPPED_READS',
+                    'UNPAIRED_READS_EXAMINED',
+                    'UNPAIRED_READ_DUPLICATES'
+        ]:
+            metrics.set(analysis['analysisId'],query,sum(z[query] for z in file['info']['metrics']['libraries']))
+
+    metrics=metrics.to_frame()
     metrics['TOTAL_READS']=(metrics['READ_PAIRS_EXAMINED']*2)+metrics['UNPAIRED_READS_EXAMINED']
     metrics['DUPLICATION_PCT']=((metrics['READ_PAIR_DUPLICATES']*2)+metrics['UNPAIRED_READ_DUPLICATES'])/metrics['TOTAL_READS']*100
     metrics['MAPPING_PCT']=(metrics['TOTAL_READS']-metrics['UNMAPPED_READS'])/metrics['TOTAL_READS']*100
@@ -739,27 +1155,24 @@ def aggregate_picard_mark_duplicates_metrics(response,analysis_exclude_list,debu
 
     return(metrics)
     
-def aggreate_picard_collect_rnaseq_metrics(response,analysis_exclude_list,debug):
+@profiler.profiled("aggreate_picard_collect_rnaseq_metrics",lambda metrics:{"rows":len(metrics)})
+def aggreate_picard_collect_rnaseq_metrics(index,analysis_exclude_list,debug):
     print("Aggregating metrics from : %s " % ('Picard:CollectRnaSeqMetrics'))
-    metrics=pd.DataFrame()
-    for count,analysis in enumerate(response.json()):
+    metrics=MetricsBuilder()
+    for count,analysis,file in index['tool'].get('Picard:CollectRnaSeqMetrics',[]):
         if analysis_exclude_list!=None:
             if analysis['analysisId'] in analysis_exclude_list:
                 continue
         if count%50==0 and debug:
             print(count)
-        for file in analysis['files']:
-            if file['info'].get('analysis_tools'):
-                if file['info']['analysis_tools'][0]=='Picard:CollectRnaSeqMetrics':
-                    if "star" in file['fileName']:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="STAR"
-                    else:
-                        metrics.loc[analysis['analysisId'],"PIPELINE"]="HISAT2"
-                    for query in [key for key in file['info']['metrics'].keys() if "pct" in key or "median" in key]:
-                        metrics.loc[analysis['analysisId'],query]=file['info']['metrics'][query]
-                    metrics.loc[analysis['analysisId'],"sampleId"]=analysis['samples'][0]['sampleId']
-            else:
-                continue
+        if "star" in file['fileName']:
+            metrics.set(analysis['analysisId'],"PIPELINE","STAR")
+        else:
+            metrics.set(analysis['analysisId'],"PIPELINE","HISAT2")
+        for query in [key for key in file['info']['metrics'].keys() if "pct" in key or "median" in key]:
+            metrics.set(analysis['analysisId'],query,file['info']['metrics'][query])
+        metrics.set(analysis['analysisId'],"sampleId",analysis['samples'][0]['sampleId'])
+    metrics=metrics.to_frame()
 
     if debug:
         print(metrics)
@@ -770,57 +1183,246 @@ def aggreate_picard_collect_rnaseq_metrics(response,analysis_exclude_list,debug)
     return(metrics)
             
             
-def song_phone_home(project,rdpc_url,state):
-    print("Calling Song API...")
-    combined_url="%s/studies/%s/analysis?analysisState=%s" % (rdpc_url,project,state)
-
-    response=requests.get(combined_url)
-
-    if response.status_code!=200:
-        sys.exit("Query response failed, return status_code :%s" % response.status_code)
-
-    print("Calling Song API...Complete")  
-    return(response)
-
-def generate_rdpc_metadata(response,experiment):
-    print("Aggregating Files and IDs...")  
-    metadata=pd.DataFrame()
-    count=0
-    for ind,analysis in enumerate(response.json()):
-        if analysis['experiment']['experimental_strategy']==experiment:
-
-            for file in analysis['files']:
-                metadata.loc[count,'fileDataType']=file['dataType']
-                metadata.loc[count,'objectId']=file['objectId']
-                metadata.loc[count,'submitterSampleId']=analysis['samples'][0]['submitterSampleId']
-                metadata.loc[count,'submitterSpecimenId']=analysis['samples'][0]['specimen']['submitterSpecimenId']
-                metadata.loc[count,'submitterDonorId']=analysis['samples'][0]['donor']['submitterDonorId']
-
-                metadata.loc[count,'tumourNormalDesignation']=analysis['samples'][0]['specimen']['tumourNormalDesignation']
-                metadata.loc[count,'matchedNormalSubmitterSampleId']=analysis['samples'][0]['matchedNormalSubmitterSampleId']
-
-                metadata.loc[count,'donorId']=analysis['samples'][0]['donor']['donorId']
-                metadata.loc[count,'specimenId']=analysis['samples'][0]['specimen']['specimenId']
-                metadata.loc[count,'sampleId']=analysis['samples'][0]['sampleId']
-
-                metadata.loc[count,'analysisId']=analysis['analysisId']
-                metadata.loc[count,'runId']=analysis['workflow']['run_id']
-                metadata.loc[count,'ind']=ind
-                count+=1
-
-    warnings=[]
-    normalSubmitterToArgo={z[0]:z[1] for z in metadata.loc[:,["submitterSampleId","sampleId"]].drop_duplicates().values.tolist()}
-    for ind in metadata.query("tumourNormalDesignation=='Tumour'").index.values.tolist():
-        submitterId=metadata.loc[ind,"matchedNormalSubmitterSampleId"]
-        if normalSubmitterToArgo.get(submitterId):
-            metadata.loc[ind,"matchedNormalSampleId"]=normalSubmitterToArgo.get(submitterId)
+class SongClient:
+    """
+    Pooled SONG client : one keep-alive session with gzip transfer, retried
+    with backoff on 5xx and timeouts. Analyses are fetched a page at a time
+    and yielded as each page arrives.
+    """
+    def __init__(self,rdpc_url,page_size=500,retries=5,backoff=0.5,timeout=(10,300)):
+        self.rdpc_url=rdpc_url.rstrip("/")
+        self.page_size=page_size
+        self.timeout=timeout
+        retry=Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=[500,502,503,504],
+            raise_on_status=False
+        )
+        adapter=HTTPAdapter(max_retries=retry,pool_connections=4,pool_maxsize=16)
+        self.session=requests.Session()
+        self.session.mount("http://",adapter)
+        self.session.mount("https://",adapter)
+        self.session.headers.update({"Accept":"application/json","Accept-Encoding":"gzip"})
+
+    def get(self,url,params=None,headers=None):
+        try:
+            response=self.session.get(url,params=params,headers=headers,timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            sys.exit("Query failed after retries : %s" % e)
+        return(response)
+
+    def pages(self,project,state,validators=None):
+        """
+        Yield (key,response,body) per SONG page, key being the page offset or
+        "all" for servers without the paginated endpoint and body the decoded
+        JSON (None for 304). A page whose ETag or Last-Modified is in
+        validators is requested conditionally and may come back as 304.
+        """
+        validators=validators or {}
+        offset=0
+        while True:
+            ###Only the request and decode of a page are timed, not what the consumer does with it
+            with profiler.stage("song_phone_home"):
+                key,response,body=self.page(project,state,offset,validators)
+            yield (key,response,body)
+            if key=="all":
+                return
+            if response.status_code==304:
+                count,total=validators[offset]['count'],validators[offset]['total']
+            else:
+                count,total=len(body['analyses']),body['totalAnalyses']
+            offset+=count
+            if count==0 or offset>=total:
+                return
+
+    def page(self,project,state,offset,validators):
+        key=offset
+        response=self.get(
+            "%s/studies/%s/analysis/paginated" % (self.rdpc_url,project),
+            params={"analysisStates":state,"limit":self.page_size,"offset":offset},
+            headers=conditional_headers(validators.get(offset))
+        )
+        ###Older SONG servers have no paginated endpoint
+        if response.status_code==404 and offset==0:
+            key="all"
+            response=self.get(
+                "%s/studies/%s/analysis" % (self.rdpc_url,project),
+                params={"analysisState":state},
+                headers=conditional_headers(validators.get("all"))
+            )
+        if response.status_code not in [200,304]:
+            sys.exit("Query response failed, return status_code :%s" % response.status_code)
+
+        body=response.json() if response.status_code==200 else None
+        if body is None:
+            analyses=validators[key]['count']
         else:
-            warnings.append("No ID associated with %s based on SONG records" % submitterId)
-            
-    for warning in list(set(warnings)):
-        print(warning)
+            analyses=len(body) if key=="all" else len(body['analyses'])
+        profiler.count("song_phone_home",pages=1,bytes=len(response.content),not_modified=int(response.status_code==304),analyses=analyses)
+        return(key,response,body)
+
+    def analyses(self,project,state,cache=None):
+        """
+        Yield analyses as pages arrive. With a SongCache, pages the server
+        reports unchanged are served from disk instead of downloaded again.
+        """
+        entry=cache.load(self.rdpc_url,project,state) if cache else None
+        cached=entry['analyses'] if entry else {}
+        validators=entry['pages'] if entry else {}
+        pages={}
+        analyses={}
+        not_modified=0
+        for key,response,body in self.pages(project,state,validators):
+            if response.status_code==304:
+                page_analyses=[cached[analysisId] for analysisId in validators[key]['ids']]
+                total=validators[key]['total']
+                not_modified+=1
+            else:
+                page_analyses=body if key=="all" else body['analyses']
+                total=len(body) if key=="all" else body['totalAnalyses']
+
+            for analysis in page_analyses:
+                analyses[analysis['analysisId']]=analysis
+                yield analysis
+
+            pages[key]={
+                "etag":response.headers.get("ETag",validators.get(key,{}).get("etag")),
+                "last_modified":response.headers.get("Last-Modified",validators.get(key,{}).get("last_modified")),
+                "ids":[analysis['analysisId'] for analysis in page_analyses],
+                "count":len(page_analyses),
+                "total":total
+            }
+
+        if cache:
+            print("Cache : %s analyses, %s of %s pages unchanged since last run" % (len(analyses),not_modified,len(pages)))
+            cache.save(self.rdpc_url,project,state,{"pages":pages,"analyses":analyses})
+
+    def close(self):
+        self.session.close()
+
+def conditional_headers(validator):
+    headers={}
+    if validator:
+        if validator.get("etag"):
+            headers["If-None-Match"]=validator["etag"]
+        if validator.get("last_modified"):
+            headers["If-Modified-Since"]=validator["last_modified"]
+    return(headers)
+
+class SongCache:
+    """
+    On-disk cache of SONG study responses keyed by (rdpc_url,project,state).
+    Decoded analyses are pickled together with the per-page validators used
+    to revalidate them on the next run.
+    """
+    def __init__(self,cache_dir):
+        self.cache_dir=cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self,rdpc_url,project,state):
+        key=hashlib.sha1(("%s|%s|%s" % (rdpc_url,project,state)).encode()).hexdigest()
+        return("%s/%s_%s_%s.pkl" % (self.cache_dir,state,project,key[:12]))
+
+    def load(self,rdpc_url,project,state):
+        path=self.path(rdpc_url,project,state)
+        if not os.path.exists(path):
+            return(None)
+        try:
+            with open(path,"rb") as file:
+                return(pickle.load(file))
+        except (pickle.UnpicklingError,EOFError) as e:
+            print("Ignoring unreadable cache %s : %s" % (path,e))
+            return(None)
+
+    def save(self,rdpc_url,project,state,entry):
+        path=self.path(rdpc_url,project,state)
+        with open(path+".tmp","wb") as file:
+            pickle.dump(entry,file,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path+".tmp",path)
+
+def song_phone_home(client,project,state,cache=None):
+    print("Calling Song API...")
+    for analysis in client.analyses(project,state,cache):
+        yield analysis
+    print("Calling Song API...Complete")
 
-    print("Aggregating Files and IDs...Complete")        
+def build_analysis_index(analyses):
+    """
+    Walk the SONG analyses once and index them for the aggregators.
+    'tool' maps analysis_tools[0] to (position,analysis,file) tuples and
+    'experiment' maps to analysis positions, both in SONG order.
+    """
+    print("Indexing analyses...")
+    index={"analyses":[],"tool":{},"experiment":{}}
+    for ind,analysis in enumerate(analyses):
+        index['analyses'].append(analysis)
+        index['experiment'].setdefault(analysis['experiment'].get('experimental_strategy'),[]).append(ind)
+        for file in analysis['files']:
+            if file['info'].get('analysis_tools'):
+                index['tool'].setdefault(file['info']['analysis_tools'][0],[]).append((ind,analysis,file))
+    print("Indexing analyses...Complete")
+    return(index)
+
+metadata_columns=[
+    'fileDataType',
+    'objectId',
+    'submitterSampleId',
+    'submitterSpecimenId',
+    'submitterDonorId',
+    'tumourNormalDesignation',
+    'matchedNormalSubmitterSampleId',
+    'donorId',
+    'specimenId',
+    'sampleId',
+    'analysisId',
+    'runId',
+    'ind'
+]
+
+def generate_rdpc_metadata(index,experiment):
+    print("Aggregating Files and IDs...")
+    ###One row per analysis x file
+    records=[]
+    for ind in index['experiment'].get(experiment,[]):
+        analysis=index['analyses'][ind]
+        sample=analysis['samples'][0]
+        for file in analysis['files']:
+            records.append((
+                file['dataType'],
+                file['objectId'],
+                sample['submitterSampleId'],
+                sample['specimen']['submitterSpecimenId'],
+                sample['donor']['submitterDonorId'],
+                sample['specimen']['tumourNormalDesignation'],
+                sample['matchedNormalSubmitterSampleId'],
+                sample['donor']['donorId'],
+                sample['specimen']['specimenId'],
+                sample['sampleId'],
+                analysis['analysisId'],
+                analysis['workflow']['run_id'],
+                ind
+            ))
+    metadata=pd.DataFrame.from_records(records,columns=metadata_columns)
+    metadata['ind']=metadata['ind'].astype(np.float64)
+
+    ###Resolve matched normals : submitterSampleId -> sampleId, last pairing wins
+    normalSubmitterToArgo=metadata.loc[:,["submitterSampleId","sampleId"]]\
+        .drop_duplicates()\
+        .drop_duplicates(subset="submitterSampleId",keep="last")\
+        .set_index("submitterSampleId")['sampleId']
+    tumours=metadata['tumourNormalDesignation']=='Tumour'
+    metadata["matchedNormalSampleId"]=metadata.loc[tumours,"matchedNormalSubmitterSampleId"].map(normalSubmitterToArgo)
+
+    unresolved=metadata.loc[tumours & metadata["matchedNormalSampleId"].isnull(),"matchedNormalSubmitterSampleId"]
+    for submitterId in unresolved.drop_duplicates().values.tolist():
+        print("No ID associated with %s based on SONG records" % submitterId)
+
+    print("Aggregating Files and IDs...Complete")
     return(metadata)
 
 
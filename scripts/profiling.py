@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""
+Per-stage wall time, peak RSS and counters for get_analysis.py and
+get-qc-stats.py.
+
+Stages are named blocks that can be entered many times (get_extra_metrics
+runs once per tarball); each keeps its call count, total seconds, the
+process peak RSS seen when it finished and any counters the stage adds.
+Stages and counts may be recorded from several threads at once.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import platform
+import threading
+import functools
+import contextlib
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+class StageProfiler(object):
+    def __init__(self):
+        self.start = time.time()
+        self.stages = OrderedDict()
+        self.lock = threading.RLock()
+
+    def reset(self):
+        self.start = time.time()
+        self.stages = OrderedDict()
+
+    def record(self, name):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': None, 'counters': OrderedDict()}
+            return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = self.record(name)
+        start = time.perf_counter()
+        try:
+            yield record['counters']
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                record['calls'] += 1
+                record['seconds'] += seconds
+                record['peak_rss_mb'] = peak_rss_mb()
+
+    def profiled(self, name, counters=None):
+        """
+        Decorator timing every call of a function as stage name; counters,
+        if given, maps the function's result to counts added to the stage.
+        """
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name) as stage:
+                    result = function(*args, **kwargs)
+                    if counters is not None:
+                        self.add(stage, counters(result))
+                return result
+            return wrapper
+        return decorate
+
+    def count(self, name, **counts):
+        with self.lock:
+            self.add(self.record(name)['counters'], counts)
+
+    @staticmethod
+    def add(counters, counts):
+        for key, value in counts.items():
+            counters[key] = counters.get(key, 0) + value
+
+    def merge(self, stages):
+        """
+        Fold in the stages of another profiler, e.g. one returned by a worker
+        process.
+        """
+        with self.lock:
+            for name, other in stages.items():
+                record = self.record(name)
+                record['calls'] += other['calls']
+                record['seconds'] += other['seconds']
+                if other['peak_rss_mb'] is not None:
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0, other['peak_rss_mb'])
+                self.add(record['counters'], other['counters'])
+
+    def report(self, script):
+        return OrderedDict([
+            ('script', script),
+            ('argv', sys.argv[1:]),
+            ('python', platform.python_version()),
+            ('started', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start))),
+            ('wall_seconds', round(time.time() - self.start, 3)),
+            ('peak_rss_mb', peak_rss_mb()),
+            ('stages', OrderedDict(
+                (name, OrderedDict([
+                    ('calls', record['calls']),
+                    ('seconds', round(record['seconds'], 4)),
+                    ('peak_rss_mb', record['peak_rss_mb']),
+                    ('counters', record['counters'])
+                ])) for name, record in self.stages.items()
+            ))
+        ])
+
+    def write(self, path, script):
+        report = self.report(script)
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            f.write(json.dumps(report, indent=2))
+
+        print('Profile : %.1fs wall, %s MB peak RSS, written to %s' % (report['wall_seconds'], report['peak_rss_mb'], path))
+        for name, record in report['stages'].items():
+            counters = ', '.join('%s=%s' % (key, value) for key, value in record['counters'].items())
+            print('  %-45s %6d calls %10.3fs  %s' % (name, record['calls'], record['seconds'], counters))
+        return report
+
+
+@contextlib.contextmanager
+def cprofiled(path):
+    """
+    Run the block under cProfile and dump its stats to path (readable with
+    pstats or snakeviz); a no-op without a path.
+    """
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        print('cProfile stats written to %s' % path)
+
+
+profiler = StageProfiler()